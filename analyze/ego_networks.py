@@ -1,108 +1,269 @@
 """
 find the size of each player's ego network for K <= 6
 
-use multiprocessing for speeeeed
+use multiprocessing for speeeeed, and a bit-parallel BFS that
+advances 64 players per machine word at once
 
 """
 
+import os
+import sys
 import math
 import numpy as np
-import ctypes
 from operator import itemgetter
 from functools import partial
-from multiprocessing import Pool, cpu_count
-import multiprocessing.util as util
-from graph_functions import load_adj_mat_multiproc
+from multiprocessing import get_context
+from graph_functions import (ensure_graph_snapshot, open_graph_snapshot,
+                             read_candidate_ids, read_id_file, drop_results,
+                             share_graph, attach_shared_graph,
+                             recent_ids_file_name, default_num_workers,
+                             pool_start_method, use_compact_graph)
+from job_runner import Checkpoint, run_batches
+import instrument
 
-#==============================================================================
-# Global variable shenanigans to get numpy to play nice with multiprocessing
 node_file_path = '../data/player_graph/nodes.csv'
 edge_file_path = '../data/player_graph/edges.csv'
-candidate_file_path = '../data/player_graph/node_ids_since_2013.txt'
+candidate_file_path = recent_ids_file_name()
+snapshot_path = '../data/player_graph/snapshot'
+stale_file_path = '../data/player_graph/stale_ego_ids.txt'
 
-# adjacency matrix and dict of node id/label
-adj_mat_base, adj_mat, nodes = load_adj_mat_multiproc(node_file_path,
-                                                      edge_file_path)
+# load the graph in compact dtypes (env BUDA_COMPACT_GRAPH=1): a fraction
+# of the memory (here and in the shared copy the workers use), same results
+compact_graph_arrays = use_compact_graph()
 
-# node IDs range from 1 to the number of nodes
-nodes_for_comparison = []
-with open(candidate_file_path) as cand_file:
-    for line in cand_file:
-        nodes_for_comparison.append(int(line))
-#==============================================================================
+# per-process graph state: adjacency matrix as a CSRGraph, dict of node
+# id/label and the node ids to process. loaded by init_worker, not at
+# import, so the BFS functions can be imported without the data files
+adj_mat = None
+nodes = None
+nodes_for_comparison = None
+shared_graph = None  # the SharedGraph adj_mat lives in, in pool workers
 
-def calc_ego_network_sizes(node_id, max_k=6, adj_mat=adj_mat):
+
+def init_worker(snapshot_dir=snapshot_path,
+                candidate_file_name=candidate_file_path, graph_handle=None,
+                compact=False):
+    """
+    load the graph snapshot and candidate ids into this process.
+    used as the Pool initializer: each worker memory-maps the same
+    snapshot, whether it was started by fork, spawn or forkserver
+
+    given the handle of a SharedGraph, workers attach to its shared
+    memory instead (and leave nodes unset, as only the parent writes
+    results).  if compact, the snapshot is copied into the smallest
+    dtypes that hold it (see graph_functions.compact_graph); a shared
+    graph keeps whatever dtypes it was shared with
+    """
+    global adj_mat, nodes, nodes_for_comparison, shared_graph
+    if graph_handle is None:
+        adj_mat, nodes = open_graph_snapshot(snapshot_dir, compact=compact)
+    else:
+        shared_graph = attach_shared_graph(graph_handle)
+        adj_mat = shared_graph.graph
+    nodes_for_comparison = read_candidate_ids(candidate_file_name)
+
+
+def loaded_graph():
+    """ the graph loaded into this process by init_worker """
+    if adj_mat is None:
+        raise RuntimeError('no graph loaded: call init_worker first')
+    return adj_mat
+
+
+def calc_ego_network_sizes(node_id, max_k=6, adj_mat=None):
     """
     calculate the size of the ego networks up to a given degree for a player
+
+    level-synchronous breadth first search over the CSR neighbor lists:
+    a visited bitmap means each hop only expands the nodes first reached
+    on the previous hop, so every node and edge is touched at most once
+
+    counts match the original dense implementation: K=1 is the number of
+    teammates, and for K >= 2 the player is counted once explicitly and
+    once more as reachable through any teammate they have
     """
     if max_k < 1:
         return
+    if adj_mat is None:
+        adj_mat = loaded_graph()
 
     ego_results = []
 
-    # do degree 1 manually
-    ego_vector = np.zeros(adj_mat.shape[1])  # in case we have down-selected
-    ego_vector[adj_mat[node_id - 1] > 0] = 1  # only place we need node id
-    ego_results.append((node_id, 1, sum(ego_vector)))  # tuple of results
-
-    # get indices we need to search
-    this_ego = np.where(ego_vector > 0)[0]
+    source = node_id - 1  # only place we need node id
+    visited = np.zeros(adj_mat.num_nodes, dtype=bool)
+    visited[source] = True
+    self_reachable = int(adj_mat.degree(source) > 0)
 
-    # set up processing loop
-    next_ego = np.zeros(adj_mat.shape[1])
-    for i in range(2, max_k + 1):
-        next_ego[:] = 0
-        for j in this_ego:
-            next_ego[adj_mat[j] > 0] = 1
-        ego_vector[next_ego > 0] = 1
+    frontier = np.array([source])
+    num_reached = 0  # not including self
+    for i in range(1, max_k + 1):
+        # newly reached nodes become the next frontier
+        reached = adj_mat.neighbors_of(frontier)
+        frontier = np.unique(reached[~visited[reached]])
+        visited[frontier] = True
+        num_reached += len(frontier)
+        instrument.count('frontier_nodes_k{0}'.format(i), len(frontier))
 
-        # update ego results and vector for next round
-        ego_results.append((node_id, i, sum(ego_vector) + 1))  # include self
-        this_ego = np.where(next_ego > 0)[0]
+        if i == 1:
+            ego_results.append((node_id, 1, num_reached))
+        else:
+            ego_results.append((node_id, i,
+                                num_reached + self_reachable + 1))
 
     return ego_results
 
 
+def count_source_bits(bitsets, num_sources):
+    """
+    for an (num_nodes, num_words) array of little-endian uint64
+    source bitsets, count how many nodes have each source's bit set
+    """
+    bits = np.unpackbits(bitsets.view(np.uint8), axis=1, bitorder='little')
+    return bits[:, :num_sources].sum(axis=0, dtype=np.int64)
+
+
+@instrument.task('ego_task')
+def calc_ego_network_sizes_batch(node_ids, max_k=6, adj_mat=None):
+    """
+    calc_ego_network_sizes for many players at once
+
+    every node keeps one bit per source player (64 per machine word)
+    for the sources that have reached it. each hop ORs the frontier
+    bitsets of a node's neighbors together, so all of the BFS runs
+    advance with one pass over the edge list
+
+    returns a list of calc_ego_network_sizes results, one per node id
+    """
+    if max_k < 1:
+        return [None for uid in node_ids]
+    if adj_mat is None:
+        adj_mat = loaded_graph()
+
+    sources = np.asarray(node_ids, dtype=np.int64) - 1
+    instrument.count('ego_sources', len(sources))
+    num_words = max(1, (len(sources) + 63) // 64)
+    source_bits = np.arange(len(sources), dtype=np.uint64)
+
+    frontier = np.zeros((adj_mat.num_nodes, num_words), dtype='<u8')
+    np.bitwise_or.at(frontier, (sources, source_bits // np.uint64(64)),
+                     np.left_shift(np.uint64(1), source_bits % np.uint64(64)))
+    visited = frontier.copy()
+
+    # reduceat over the starts of non-empty rows ORs exactly each row
+    nonempty = np.flatnonzero(adj_mat.degree() > 0)
+    row_starts = adj_mat.indptr[nonempty]
+    self_reachable = (adj_mat.degree()[sources] > 0).astype(int)
+
+    sizes = []
+    num_reached = np.zeros(len(sources), dtype=int)  # not including self
+    for i in range(1, max_k + 1):
+        reached = np.zeros_like(frontier)
+        if len(nonempty):
+            reached[nonempty] = np.bitwise_or.reduceat(
+                frontier[adj_mat.indices], row_starts, axis=0)
+        frontier = reached & ~visited
+        visited |= frontier
+        num_reached += count_source_bits(frontier, len(sources))
+        if instrument.enabled:
+            instrument.count('batch_frontier_nodes_k{0}'.format(i),
+                             np.count_nonzero(frontier.any(axis=1)))
+
+        # same counting convention as calc_ego_network_sizes
+        if i == 1:
+            sizes.append(num_reached.copy())
+        else:
+            sizes.append(num_reached + self_reachable + 1)
+
+    return [[(uid, i + 1, int(sizes[i][n])) for i in range(max_k)]
+            for n, uid in enumerate(node_ids)]
+
+
+def format_ego_result(result, sample_size):
+    """
+    a (uid, K, size) result as its uid and its uid,K,fraction of
+    sample_size csv lines
+    """
+    uid = result[0][0]
+    return uid, ['{0},{1},{2}\n'.format(uid, ego_degree,
+                                        round(num_nodes / sample_size, 4))
+                 for (uid, ego_degree, num_nodes) in result]
+
+
+@instrument.timed('write_results')
+def write_ego_results(ego_results, sample_size, file_out, processed):
+    """
+    write (uid, K, size) results as uid,K,fraction of sample_size rows
+    to file_out, and log each finished uid to processed.  shared by the
+    exact BFS and the approximate counters in hyper_anf.py, so
+    jsonify_results.py reads either
+    """
+    for result in ego_results:
+        if not result:
+            continue
+        # write the result
+        uid, lines = format_ego_result(result, sample_size)
+        file_out.writelines(lines)
+        # log that we have another result
+        print(uid, file=processed)
+
+
 if __name__ == "__main__":
-    # load node id's that we have already processed
-    processed_ids = set()
-    try:
-        with open('results/processed_ego_ids.txt') as file_in:
-            for line in file_in:
-                processed_ids.add(int(line))
-    except:
-        pass
+    # compile the snapshot once so every worker can just map it
+    with instrument.stage('load_graph'):
+        ensure_graph_snapshot(node_file_path, edge_file_path, snapshot_path)
+        init_worker(compact=compact_graph_arrays)
+
+    # load node id's that we have already processed, first undoing
+    # any batch an interrupted run didn't finish writing
+    checkpoint = Checkpoint('results/ego_results.csv',
+                            'results/processed_ego_ids.txt', lambda ids: ids)
+    processed_ids = checkpoint.recover()
+
+    # recompute the players a new season made stale (see temporal_graph.py)
+    stale_ids = read_id_file(stale_file_path)
+    if stale_ids:
+        drop_results('results/ego_results.csv',
+                     'results/processed_ego_ids.txt', stale_ids, stale_ids)
+        processed_ids -= stale_ids
+    if os.path.exists(stale_file_path):
+        os.remove(stale_file_path)
 
     # process the rest
     nodes_to_process = [x for x in nodes_for_comparison if x not in processed_ids]
 
-    # parallel generation of results
-    util.log_to_stderr(util.SUBDEBUG)
-    n_cores = cpu_count()
-    chunksize = max(1, len(nodes_to_process) // (2 * (n_cores - 1)))
-
-    
-    pool = Pool(processes=(n_cores - 1))
-    ego_results = pool.imap(calc_ego_network_sizes,
-                                   nodes_to_process,
-                                   chunksize=chunksize)
-
-    # write results to file
-    sample_size = len(nodes)
-    with open('results/ego_results.csv', 'a') as file_out, \
-         open('results/processed_ego_ids.txt', 'a') as processed:
-        for result in ego_results:
-            if not result:
-                continue
-            # write the result
-            for (uid, ego_degree, num_nodes) in result:
-                print(uid, ego_degree, round(num_nodes / sample_size, 4),
-                      sep=',', file=file_out)
-            # log that we have another result
-            print(uid, file=processed)
+    # batches of players to run through the bit-parallel BFS together,
+    # highest degree first; small enough to spread out the tail
+    sources_per_batch = 64
+    nodes_to_process.sort(key=lambda x: -adj_mat.degree(x - 1))
+    batches = [nodes_to_process[i:i + sources_per_batch]
+               for i in range(0, len(nodes_to_process), sources_per_batch)]
+    costs = [int(adj_mat.degree()[np.array(batch) - 1].sum())
+             for batch in batches]
 
-    pool.close()
-    pool.join()
+    # python ego_networks.py --profile [node id]: run one task (that
+    # player's, or the costliest batch) under cProfile and stop there
+    if '--profile' in sys.argv[1:]:
+        args = sys.argv[sys.argv.index('--profile') + 1:]
+        batch = [int(args[0])] if args else batches[int(np.argmax(costs))]
+        instrument.profile_call('results/ego_task.prof',
+                                calc_ego_network_sizes_batch, batch)
+        sys.exit()
+
+    # parallel generation of results: workers attach to one shared copy
+    # of the graph in init_worker, so any start method works (env
+    # BUDA_START_METHOD); this process unlinks it when done
+    shared = share_graph(adj_mat)
+    pool = get_context(pool_start_method()).Pool(
+        processes=default_num_workers(), initializer=init_worker,
+        initargs=(snapshot_path, candidate_file_path, shared.handle))
 
+    # write results to file, a batch at a time
+    run_batches(pool, calc_ego_network_sizes_batch, batches, costs,
+                checkpoint, partial(format_ego_result, sample_size=len(nodes)))
 
+    pool.close()
+    pool.join()
+    shared.close()
 
+    # with BUDA_PROFILE set, where the time went (see instrument.py)
+    instrument.write_summary()
@@ -2,9 +2,156 @@
 helper modules to compute and manipulate graph
 networks
 """
+import os
+import sys
+import json
+import shutil
+import atexit
+import tempfile
+import signal
 import numpy as np
-from multiprocessing import Array
-import ctypes
+from multiprocessing import shared_memory, cpu_count
+from instrument import timed
+
+# arrays making up a graph snapshot, one .npy file each
+SNAPSHOT_ARRAYS = ('indptr', 'indices', 'weights', 'weighted_degrees', 'norms')
+SNAPSHOT_VERSION = 1
+
+
+def segment_sums(values, indptr):
+    """
+    sum values[..., indptr[i]:indptr[i+1]] for every segment i
+    (works along the last axis, so values can be one row or a block)
+    """
+    shape = values.shape[:-1] + (1,)
+    totals = np.concatenate((np.zeros(shape, dtype=values.dtype),
+                             np.cumsum(values, axis=-1)), axis=-1)
+    return totals[..., indptr[1:]] - totals[..., indptr[:-1]]
+
+
+def widen(array):
+    """
+    array as int64 (float64 if it holds floats), for arithmetic on the
+    compact arrays of a graph from compact_graph; no copy if it already is
+    """
+    return array.astype(np.result_type(array.dtype, np.int64), copy=False)
+
+
+def smallest_uint(max_value):
+    """
+    the smallest unsigned integer dtype holding 0 .. max_value, or int64
+    past uint32 (uint64 doesn't mix with the int64 arrays it meets)
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def check_fits(values, dtype, name):
+    """ raise ValueError unless every one of values fits in dtype """
+    dtype = np.dtype(dtype)
+    if not len(values) or dtype.kind == 'f':
+        return
+    info = np.iinfo(dtype)
+    low, high = values.min(), values.max()
+    if low < info.min or high > info.max:
+        raise ValueError('{0} from {1} to {2} do not fit in {3}'.format(
+                         name, low, high, dtype))
+
+
+def gather_positions(indptr, rows):
+    """
+    for compressed rows delimited by indptr, return the positions of
+    every entry of the given rows, concatenated in row order, along
+    with each row's length
+    """
+    starts = widen(indptr[rows])
+    lengths = indptr[np.asarray(rows) + 1] - starts
+    ends = np.cumsum(lengths)
+    offsets = np.arange(ends[-1] if len(ends) else 0) - np.repeat(
+        ends - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets, lengths
+
+
+class CSRGraph(object):
+    """
+    compressed sparse row adjacency structure for the undirected graph
+
+    row i holds the node with id i+1 (like the rows of the dense
+    adjacency matrix): its neighbors' matrix indices are
+    indices[indptr[i]:indptr[i+1]], in ascending order, and the matching
+    edge weights are weights[indptr[i]:indptr[i+1]]
+
+    the per-row reductions the analyses keep asking for are computed
+    once here and cached alongside the adjacency:
+    weighted_degrees is each row's sum of weights (its L1 norm, since
+    weights are positive) and norms is each row's L2 norm
+    """
+    def __init__(self, indptr, indices, weights,
+                 weighted_degrees=None, norms=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.num_nodes = len(indptr) - 1
+
+        if weighted_degrees is None:
+            weighted_degrees = segment_sums(widen(weights), indptr)
+        if norms is None:
+            norms = np.sqrt(segment_sums(widen(weights) * widen(weights),
+                                         indptr).astype(float))
+        self.weighted_degrees = weighted_degrees
+        self.norms = norms
+
+    @property
+    def shape(self):
+        """ shape of the equivalent dense adjacency matrix """
+        return (self.num_nodes, self.num_nodes)
+
+    @property
+    def num_edges(self):
+        """ number of undirected edges """
+        return len(self.indices) // 2
+
+    def __len__(self):
+        return self.num_nodes
+
+    def row(self, i):
+        """ return (neighbor indices, edge weights) of matrix row i """
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:stop], self.weights[start:stop]
+
+    def neighbors(self, i):
+        """ return the matrix indices of the neighbors of matrix row i """
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def degree(self, i=None):
+        """ node degree of matrix row i, or of every row if i is None """
+        if i is None:
+            return widen(np.diff(self.indptr))
+        return int(self.indptr[i + 1] - self.indptr[i])
+
+    def entry_positions(self, rows):
+        """
+        positions in indices/weights of every entry of the given matrix
+        rows, concatenated in row order, along with each row's length
+        """
+        return gather_positions(self.indptr, rows)
+
+    def neighbors_of(self, rows):
+        """ concatenated neighbor indices of the given matrix rows """
+        return self.indices[self.entry_positions(rows)[0]]
+
+    def row_ids(self):
+        """ matrix row of every stored entry, parallel to indices """
+        return np.repeat(np.arange(self.num_nodes), self.degree())
+
+    def iter_neighbors(self, i):
+        """ yield (neighbor index, edge weight) pairs for matrix row i """
+        indices, weights = self.row(i)
+        for j, weight in zip(indices, weights):
+            yield int(j), int(weight)
+
 
 def read_nodes(node_file_name):
     """ read in a nodes file into dict of id: label """
@@ -17,6 +164,7 @@ def read_nodes(node_file_name):
     return nodes
 
 
+@timed('read_edges')
 def read_edges(edge_file_name):
     """ read in an edges file into dict of (src, tgt) : weight """
     edges = {}
@@ -28,6 +176,58 @@ def read_edges(edge_file_name):
     return edges
 
 
+@timed('read_edges')
+def read_edge_arrays(edge_file_name):
+    """
+    read an edges file straight into numpy arrays of
+    source ids, target ids and weights
+    """
+    edges = np.loadtxt(edge_file_name, delimiter=',', skiprows=1,
+                       usecols=(0, 1, 3), dtype=np.int64, ndmin=2)
+    return edges[:, 0], edges[:, 1], edges[:, 2]
+
+
+def read_candidate_ids(candidate_file_name):
+    """ read a file of node ids, one per line, into a list """
+    candidate_ids = []
+    with open(candidate_file_name) as file_in:
+        for line in file_in:
+            candidate_ids.append(int(line))
+    return candidate_ids
+
+
+def default_year_thresh():
+    """ the season recent players are counted from (env BUDA_YEAR_THRESH) """
+    return int(os.environ.get('BUDA_YEAR_THRESH', 2013))
+
+
+def default_num_workers():
+    """
+    the number of pool workers for the analyses (env BUDA_WORKERS,
+    default one less than the number of cpus)
+    """
+    return int(os.environ.get('BUDA_WORKERS', 0)) or max(1, cpu_count() - 1)
+
+
+def pool_start_method():
+    """
+    the multiprocessing start method for the analyses' pools (env
+    BUDA_START_METHOD: fork, spawn or forkserver), None for the
+    platform default.  workers attach to a shared graph, so any works
+    """
+    return os.environ.get('BUDA_START_METHOD') or None
+
+
+def recent_ids_file_name(year_thresh=None):
+    """
+    the list of players seen since year_thresh that find_recent_players.py
+    writes and the analyses read (default_year_thresh() if None)
+    """
+    if year_thresh is None:
+        year_thresh = default_year_thresh()
+    return '../data/player_graph/node_ids_since_{0}.txt'.format(year_thresh)
+
+
 def find_edge(edges, player_one, player_two):
     """
     find an edge between two players if it exists
@@ -57,6 +257,7 @@ def build_adjacency_vector(nodes, edges, player_id):
     return adjacency_vec
 
 
+@timed('build_adjacency_matrix')
 def build_adjacency_matrix(nodes, edges):
     """
     build the full adjacency matrix for the undirected graph
@@ -68,7 +269,7 @@ def build_adjacency_matrix(nodes, edges):
     num_nodes = len(nodes)
 
     # init the matrix
-    adj_mat = np.zeros((num_nodes, num_nodes), dtype=np.int)
+    adj_mat = np.zeros((num_nodes, num_nodes), dtype=np.int64)
 
     # loop over edges and assign to matrix
     for key, weight in edges.items():
@@ -79,8 +280,215 @@ def build_adjacency_matrix(nodes, edges):
     return adj_mat
 
 
-def load_adjacency_matrix(node_file_name, edge_file_name):
-    """ wrapper for build_adjacency_matrix.  also return nodes """
+@timed('build_adjacency_matrix')
+def build_csr_graph(num_nodes, sources, targets, weights):
+    """
+    build the CSRGraph for the undirected graph defined by parallel
+    arrays of source ids, target ids and weights, without ever
+    allocating the dense matrix
+
+    like build_adjacency_matrix, zero weights are not edges and if an
+    edge is listed more than once (e.g. as both A-B and B-A) the later
+    listing wins
+    """
+    keep = weights != 0
+    sources, targets, weights = sources[keep], targets[keep], weights[keep]
+
+    # store both directions of each edge, remembering file order
+    rows = np.concatenate((sources - 1, targets - 1))
+    cols = np.concatenate((targets - 1, sources - 1))
+    vals = np.concatenate((weights, weights))
+    position = np.tile(np.arange(len(sources)), 2)
+
+    # sort by row, then column, then file order; keep the last of each cell
+    order = np.lexsort((position, cols, rows))
+    rows, cols, vals = rows[order], cols[order], vals[order]
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols, vals = rows[last], cols[last], vals[last]
+
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+
+    return CSRGraph(indptr, cols, vals)
+
+
+def add_edge_weights(graph, num_nodes, sources, targets, weights):
+    """
+    add weights onto the undirected edges (sources, targets) of graph,
+    growing it to num_nodes nodes, and return the updated CSRGraph
+    along with the matrix rows whose edges changed and the rows that
+    gained a new edge
+
+    if every edge already exists and no nodes are added, the weights,
+    weighted degrees and norms are updated in place (so graph must not
+    be mapped from a snapshot, see open_graph_snapshot) and graph itself
+    is returned; otherwise a new CSRGraph is built with the summed
+    weights
+    """
+    keep = weights != 0
+    rows = np.concatenate((sources[keep] - 1, targets[keep] - 1))
+    cols = np.concatenate((targets[keep] - 1, sources[keep] - 1))
+    vals = np.concatenate((weights[keep], weights[keep]))
+    changed = np.unique(rows)
+
+    # row-major cell keys: sorted for the graph, since each row's
+    # indices are ascending
+    graph_keys = graph.row_ids() * num_nodes + graph.indices
+    keys = rows * num_nodes + cols
+    positions = np.searchsorted(graph_keys, keys)
+    found = positions < len(graph_keys)
+    found[found] = graph_keys[positions[found]] == keys[found]
+
+    if found.all() and num_nodes == graph.num_nodes:
+        # a compact graph's arrays may not hold the new totals
+        for array, where, name in ((graph.weights, positions, 'edge weights'),
+                                   (graph.weighted_degrees, rows,
+                                    'weighted degrees')):
+            added = np.bincount(where, weights=vals, minlength=len(array))
+            check_fits(widen(array) + added.astype(np.int64), array.dtype, name)
+
+        np.add.at(graph.weights, positions, vals)
+        np.add.at(graph.weighted_degrees, rows, vals)
+        entries, lengths = graph.entry_positions(changed)
+        indptr = np.zeros(len(changed) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        squares = widen(graph.weights[entries]) ** 2
+        graph.norms[changed] = np.sqrt(segment_sums(squares, indptr)
+                                       .astype(float))
+        return graph, changed, np.zeros(0, dtype=np.int64)
+
+    # merge old and new cells, summing the weights of shared ones
+    all_keys = np.concatenate((graph_keys, keys))
+    cells, inverse = np.unique(all_keys, return_inverse=True)
+    summed = np.bincount(inverse, weights=np.concatenate((widen(graph.weights),
+                                                          vals)))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells // num_nodes, minlength=num_nodes),
+              out=indptr[1:])
+    check_fits(summed, graph.weights.dtype, 'edge weights')
+    merged = CSRGraph(indptr, cells % num_nodes,
+                      summed.astype(graph.weights.dtype))
+    return merged, changed, np.unique(rows[~found])
+
+
+def nodes_within(graph, rows, hops):
+    """ boolean mask of the nodes within hops of any of the given rows """
+    reached = np.zeros(graph.num_nodes, dtype=bool)
+    frontier = np.unique(np.asarray(rows, dtype=np.int64))
+    reached[frontier] = True
+    for i in range(hops):
+        if not len(frontier):
+            break
+        neighbors = graph.neighbors_of(frontier)
+        frontier = np.unique(neighbors[~reached[neighbors]])
+        reached[frontier] = True
+    return reached
+
+
+def read_id_file(file_name):
+    """ set of the integer ids listed one per line in file_name, if any """
+    ids = set()
+    if os.path.exists(file_name):
+        with open(file_name) as file_in:
+            for line in file_in:
+                if line.strip():
+                    ids.add(int(line))
+    return ids
+
+
+def drop_results(results_file_name, processed_file_name, keys, ids):
+    """
+    remove the rows of a results csv whose first column is in keys,
+    and the matching ids from its processed id list, so those players
+    are computed again on the next run
+    """
+    keys = set(str(key).strip() for key in keys)
+    for file_name, drop in ((results_file_name, keys),
+                            (processed_file_name, set(str(i) for i in ids))):
+        if not os.path.exists(file_name):
+            continue
+        with open(file_name) as file_in:
+            lines = [line for line in file_in
+                     if line.split(',')[0].strip() not in drop]
+        with open(file_name, 'w') as file_out:
+            file_out.writelines(lines)
+
+
+def use_compact_graph():
+    """ whether to load the graph in compact dtypes (env BUDA_COMPACT_GRAPH) """
+    return os.environ.get('BUDA_COMPACT_GRAPH', '') not in ('', '0')
+
+
+def compact_graph(graph, weight_dtype=None, index_dtype=None,
+                  norm_dtype=np.float64):
+    """
+    a copy of graph in compact dtypes: by default the smallest unsigned
+    ints that hold its weights, node indices, entry offsets and weighted
+    degrees (edge weights are co-occurrence counts, so usually a byte).
+    any dtype given is checked against the data, raising ValueError if
+    it overflows
+
+    scores and ego network sizes come out the same, as the analyses
+    widen what they compute with.  norms stay float64 by default: as
+    float32 they save little (one per node) and can move scores in the
+    last bits, which may reorder near-ties
+    """
+    weights = graph.weights
+    if len(weights) and weights.min() < 0:
+        raise ValueError('edge weights must not be negative')
+    if weight_dtype is None:
+        weight_dtype = smallest_uint(weights.max(initial=0))
+    if index_dtype is None:
+        index_dtype = smallest_uint(max(0, graph.num_nodes - 1))
+    degree_dtype = smallest_uint(graph.weighted_degrees.max(initial=0))
+    indptr_dtype = smallest_uint(len(graph.indices))
+
+    arrays = []
+    for array, dtype, name in ((graph.indptr, indptr_dtype, 'entry offsets'),
+                               (graph.indices, index_dtype, 'node indices'),
+                               (weights, weight_dtype, 'edge weights'),
+                               (graph.weighted_degrees, degree_dtype,
+                                'weighted degrees'),
+                               (graph.norms, norm_dtype, 'norms')):
+        check_fits(array, dtype, name)
+        arrays.append(np.ascontiguousarray(array, dtype=dtype))
+    return CSRGraph(*arrays)
+
+
+def graph_nbytes(graph):
+    """ bytes held by the arrays of a CSRGraph """
+    return sum(getattr(graph, name).nbytes for name in SNAPSHOT_ARRAYS)
+
+
+def load_csr_graph(node_file_name, edge_file_name, compact=False):
+    """
+    wrapper for build_csr_graph.  also return nodes
+
+    if compact, return the graph in the smallest dtypes that hold it
+    (see compact_graph)
+    """
+    # read in nodes as dict of id : name
+    nodes = read_nodes(node_file_name)
+    # read in edges as arrays of source, target, weight
+    sources, targets, weights = read_edge_arrays(edge_file_name)
+
+    # player graph as compressed sparse rows
+    graph = build_csr_graph(len(nodes), sources, targets, weights)
+    if compact:
+        graph = compact_graph(graph)
+    return graph, nodes
+
+
+def load_adjacency_matrix(node_file_name, edge_file_name, sparse=False):
+    """
+    wrapper for build_adjacency_matrix.  also return nodes
+
+    if sparse, return a CSRGraph instead of the dense matrix
+    """
+    if sparse:
+        return load_csr_graph(node_file_name, edge_file_name)
+
     # read in nodes as dict of id : name
     nodes = read_nodes(node_file_name)
     # read in edges as dict of (src,tgt),weight
@@ -91,37 +499,199 @@ def load_adjacency_matrix(node_file_name, edge_file_name):
     return adj_mat, nodes
 
 
-def build_adj_mat_multiproc(nodes, edges):
+class SharedGraph(object):
+    """
+    a CSRGraph whose arrays (with the cached degrees and norms) live in
+    named multiprocessing.shared_memory segments
+
+    the process that calls share_graph owns the segments and unlinks
+    them when closed, at interpreter exit, or on SIGTERM; workers get
+    the small, picklable handle (e.g. through a Pool initializer) and
+    attach_shared_graph maps the same memory, with no locks, copies or
+    reliance on fork.  if the owner is killed outright, the
+    multiprocessing resource tracker unlinks the segments instead
+    """
+    def __init__(self, segments, handle, owner_pid=None):
+        self.segments = segments
+        self.handle = handle
+        self.owner_pid = owner_pid
+        self.graph = CSRGraph(*[
+            np.ndarray((length,), dtype=np.dtype(dtype), buffer=segment.buf)
+            for segment, (name, _, dtype, length) in zip(segments, handle)])
+
+    def close(self):
+        """ detach from the segments, unlinking them if this is the owner """
+        if self.segments is None:
+            return
+        self.graph = None  # drop the views into the buffers first
+        for segment in self.segments:
+            segment.close()
+            if self.owner_pid == os.getpid():
+                segment.unlink()
+        self.segments = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _exit_on_sigterm(signum, frame):
+    """ turn SIGTERM into a normal exit, so cleanup handlers run """
+    sys.exit(128 + signum)
+
+
+def share_graph(graph):
+    """
+    copy a CSRGraph into new shared memory segments and return the
+    owning SharedGraph; its handle is what workers attach with
+    """
+    segments = []
+    handle = []
+    for name in SNAPSHOT_ARRAYS:
+        array = np.ascontiguousarray(getattr(graph, name))
+        segment = shared_memory.SharedMemory(create=True,
+                                             size=max(1, array.nbytes))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+        shared[:] = array
+        del shared
+        segments.append(segment)
+        handle.append((name, segment.name, array.dtype.str, len(array)))
+
+    shared_graph = SharedGraph(segments, tuple(handle), os.getpid())
+    atexit.register(shared_graph.close)
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    return shared_graph
+
+
+def attach_shared_graph(handle):
+    """ attach to the segments of a SharedGraph by its handle """
+    segments = [shared_memory.SharedMemory(name=segment_name)
+                for _, segment_name, _, _ in handle]
+    return SharedGraph(segments, handle)
+
+
+def save_graph_snapshot(graph, nodes, snapshot_dir):
     """
-    like build_adjacency_matrix, but returning a numpy wrapper to a
-    multiprocessing.Array
+    write graph and its node labels to snapshot_dir as a compiled,
+    memory-mappable snapshot: one .npy file per CSR array (plus the
+    cached degrees and norms), labels.npy holding the label of node id
+    i+1 at position i, and a small meta.json written last
+
+    the files are written to a temporary directory next to snapshot_dir
+    and renamed into place, so an interrupted save leaves the old
+    snapshot alone, and graph can itself be mapped from that snapshot
     """
     num_nodes = len(nodes)
+    if sorted(nodes) != list(range(1, num_nodes + 1)):
+        raise ValueError('node ids must run from 1 to the number of nodes')
 
-    # init the matrix
-    adj_mat_base = Array(ctypes.c_int, num_nodes * num_nodes)
-    adj_mat = np.ctypeslib.as_array(adj_mat_base.get_obj())
-    adj_mat = adj_mat.reshape(num_nodes, num_nodes)
+    snapshot_dir = os.path.normpath(snapshot_dir)
+    parent_dir, base_name = os.path.split(snapshot_dir)
+    parent_dir = parent_dir or '.'
+    os.makedirs(parent_dir, exist_ok=True)
+    new_dir = tempfile.mkdtemp(prefix='.' + base_name + '.new.',
+                               dir=parent_dir)
+    try:
+        for name in SNAPSHOT_ARRAYS:
+            np.save(os.path.join(new_dir, name + '.npy'),
+                    np.ascontiguousarray(getattr(graph, name)))
+        labels = np.array([nodes[uid] for uid in range(1, num_nodes + 1)])
+        np.save(os.path.join(new_dir, 'labels.npy'), labels)
+        write_snapshot_meta(graph, new_dir)
+    except BaseException:
+        shutil.rmtree(new_dir, ignore_errors=True)
+        raise
 
-    # loop over edges and assign to matrix
-    for key, weight in edges.items():
-        src, tgt = key
-        adj_mat[src-1, tgt-1] = weight
-        adj_mat[tgt-1, src-1] = weight
+    # a directory can't be renamed over a non-empty one: move the old
+    # snapshot aside first.  readers that still map its files keep them
+    old_dir = None
+    if os.path.exists(snapshot_dir):
+        old_dir = tempfile.mkdtemp(prefix='.' + base_name + '.old.',
+                                   dir=parent_dir)
+        os.rename(snapshot_dir, os.path.join(old_dir, base_name))
+    os.rename(new_dir, snapshot_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
 
-    return adj_mat_base, adj_mat
 
+def write_snapshot_meta(graph, snapshot_dir):
+    """
+    (re)write the snapshot's meta.json, which also marks it as newer
+    than the csv files
+    """
+    meta = {'version': SNAPSHOT_VERSION,
+            'num_nodes': int(graph.num_nodes),
+            'num_edges': int(graph.num_edges)}
+    with open(os.path.join(snapshot_dir, 'meta.json'), 'w') as file_out:
+        print(json.dumps(meta), file=file_out)
 
-def load_adj_mat_multiproc(node_file_name, edge_file_name):
-    """ wrapper for build_adj_mat_multiproc.  also return nodes """
-    # read in nodes as dict of id : name
-    nodes = read_nodes(node_file_name)
-    # read in edges as dict of (src,tgt),weight
-    edges = read_edges(edge_file_name)
 
-    # player graph as adjacency matrix
-    adj_mat_base, adj_mat = build_adj_mat_multiproc(nodes, edges)
-    return adj_mat_base, adj_mat, nodes
+def open_graph_snapshot(snapshot_dir, in_memory=False, compact=False):
+    """
+    open a snapshot written by save_graph_snapshot. the arrays are
+    np.memmaps, so opening is nearly free and worker processes share
+    the same pages instead of copying the graph.  also return nodes
 
+    if in_memory, the arrays are read into memory instead, so they can
+    be changed (see add_edge_weights) without touching the snapshot
+    files, and saved back with save_graph_snapshot.  if compact, they
+    are copied into memory in the smallest dtypes that hold them (see
+    compact_graph)
+    """
+    with open(os.path.join(snapshot_dir, 'meta.json')) as file_in:
+        meta = json.loads(file_in.read())
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise ValueError('unsupported graph snapshot version: ' +
+                         str(meta['version']))
+
+    # plain ndarray views of the memmaps: same pages, no subclass overhead
+    mode = None if in_memory else 'r'
+    arrays = [np.asarray(np.load(os.path.join(snapshot_dir, name + '.npy'),
+                                 mmap_mode=mode))
+              for name in SNAPSHOT_ARRAYS]
+    graph = CSRGraph(*arrays)
+    if compact:
+        graph = compact_graph(graph)
+
+    labels = np.load(os.path.join(snapshot_dir, 'labels.npy'))
+    nodes = dict(enumerate(labels.tolist(), 1))
+    return graph, nodes
 
 
+def snapshot_is_current(snapshot_dir, node_file_name, edge_file_name):
+    """
+    True if snapshot_dir holds a snapshot at least as new as both the
+    nodes and the edges (a missing csv file doesn't count against it)
+    """
+    meta_file_name = os.path.join(snapshot_dir, 'meta.json')
+    if not os.path.exists(meta_file_name):
+        return False
+    snapshot_time = os.path.getmtime(meta_file_name)
+    return all(snapshot_time >= os.path.getmtime(file_name)
+               for file_name in (node_file_name, edge_file_name)
+               if os.path.exists(file_name))
+
+
+def load_graph(node_file_name, edge_file_name, snapshot_dir, compact=False):
+    """
+    open the graph snapshot in snapshot_dir if it is up to date,
+    otherwise fall back to parsing the csv files.  also return nodes
+
+    if compact, the graph is in the smallest dtypes that hold it
+    """
+    if snapshot_is_current(snapshot_dir, node_file_name, edge_file_name):
+        return open_graph_snapshot(snapshot_dir, compact=compact)
+    return load_csr_graph(node_file_name, edge_file_name, compact)
+
+
+def ensure_graph_snapshot(node_file_name, edge_file_name, snapshot_dir):
+    """
+    make sure snapshot_dir holds a current snapshot, compiling one
+    from the csv files if it is missing or older than either of them
+    """
+    if not snapshot_is_current(snapshot_dir, node_file_name, edge_file_name):
+        graph, nodes = load_csr_graph(node_file_name, edge_file_name)
+        save_graph_snapshot(graph, nodes, snapshot_dir)
@@ -0,0 +1,194 @@
+"""
+approximate ego network sizes for every player at once (HyperANF)
+
+each node gets a HyperLogLog counter of the nodes within K hops of it.
+the union of two HyperLogLog counters is just their register-wise max,
+so one hop for every node is a max over its neighbors' registers, one
+vectorized pass over the edge list. max_k passes give every node's
+ball sizes for K = 1 .. max_k
+
+error: the union is exact, so the K-hop estimate carries only the
+error of a single HyperLogLog count of that ball: a relative standard
+error of about 1.04 / sqrt(m) for m = 2**log2m registers, the same for
+every K (~6.5% for the default m = 256, ~3.3% for m = 1024).  K = 1 is
+the degree and is reported exactly.  memory is num_nodes * m bytes per
+copy of the counters
+
+results use the same (uid, K, size) tuples and counting convention as
+calc_ego_network_sizes, and are written by the same write_ego_results
+"""
+
+import os
+import sys
+import numpy as np
+import ego_networks
+import instrument
+from graph_functions import ensure_graph_snapshot
+from ego_networks import (init_worker, loaded_graph,
+                          calc_ego_network_sizes_batch, write_ego_results)
+
+node_file_path = '../data/player_graph/nodes.csv'
+edge_file_path = '../data/player_graph/edges.csv'
+snapshot_path = '../data/player_graph/snapshot'
+
+
+def splitmix64(values):
+    """ splitmix64 finalizer: well-mixed 64 bit hashes of uint64 values """
+    z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def leading_zeros(values):
+    """ number of leading zero bits of each uint64 (64 for zero) """
+    values = values.astype(np.uint64)
+    count = np.zeros(len(values), dtype=np.int64)
+    for width in (32, 16, 8, 4, 2, 1):
+        empty = values < (np.uint64(1) << np.uint64(64 - width))
+        count += width * empty
+        values = np.where(empty, values << np.uint64(width), values)
+    return count + (values == 0)
+
+
+def init_counters(num_nodes, log2m=8, seed=0):
+    """
+    (num_nodes, 2**log2m) uint8 HyperLogLog registers, each node's
+    counter holding just the node itself
+    """
+    num_registers = 1 << log2m
+    hashes = splitmix64(np.arange(num_nodes, dtype=np.uint64) +
+                        np.uint64(seed) * np.uint64(num_nodes))
+    buckets = (hashes >> np.uint64(64 - log2m)).astype(np.int64)
+    rest = hashes << np.uint64(log2m)
+    ranks = np.minimum(leading_zeros(rest), 64 - log2m) + 1
+
+    counters = np.zeros((num_nodes, num_registers), dtype=np.uint8)
+    counters[np.arange(num_nodes), buckets] = ranks
+    return counters
+
+
+def estimate_counts(counters):
+    """
+    HyperLogLog cardinality estimates, one per row of counters, with
+    the linear counting correction for small sets
+    """
+    num_registers = counters.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / num_registers)
+    harmonic = np.ldexp(1.0, -counters.astype(np.int64)).sum(axis=1)
+    estimates = alpha * num_registers ** 2 / harmonic
+
+    zeros = (counters == 0).sum(axis=1)
+    small = (estimates <= 2.5 * num_registers) & (zeros > 0)
+    estimates[small] = num_registers * np.log(num_registers / zeros[small])
+    return estimates
+
+
+def union_neighbors(graph, counters, max_entries=1 << 24):
+    """
+    one HyperANF hop: each node's counter unioned (register-wise max)
+    with its neighbors' counters.  rows are processed in runs of at
+    most max_entries gathered registers to bound memory
+    """
+    result = counters.copy()
+    degrees = graph.degree()
+    nonempty = np.flatnonzero(degrees > 0)
+    rows_per_run = max(1, max_entries // max(1, counters.shape[1] *
+                                              int(degrees.mean() + 1)))
+    for first in range(0, len(nonempty), rows_per_run):
+        rows = nonempty[first:first + rows_per_run]
+        start, stop = graph.indptr[rows[0]], graph.indptr[rows[-1] + 1]
+        gathered = counters[graph.indices[start:stop]]
+        reached = np.maximum.reduceat(gathered, graph.indptr[rows] - start,
+                                      axis=0)
+        result[rows] = np.maximum(result[rows], reached)
+    return result
+
+
+def approx_ego_network_sizes(node_ids, max_k=6, adj_mat=None, log2m=8,
+                             seed=0):
+    """
+    approximate calc_ego_network_sizes for every player in node_ids,
+    from max_k HyperANF passes over the whole graph
+
+    returns a list of (uid, K, size) results, one per node id, with
+    float sizes for K >= 2
+    """
+    if max_k < 1:
+        return [None for uid in node_ids]
+    if adj_mat is None:
+        adj_mat = loaded_graph()
+
+    rows = np.asarray(node_ids, dtype=np.int64) - 1
+    degrees = adj_mat.degree()
+    self_reachable = (degrees[rows] > 0).astype(int)
+
+    # counters of the 1-hop balls; K = 1 itself is just the degree
+    counters = union_neighbors(adj_mat, init_counters(adj_mat.num_nodes,
+                                                      log2m, seed))
+    num_reached = degrees[rows].astype(float)  # not including self
+    sizes = [num_reached]
+    for i in range(2, max_k + 1):
+        counters = union_neighbors(adj_mat, counters)
+        # the ball includes the player, and balls only grow with K
+        num_reached = np.maximum(estimate_counts(counters[rows]) - 1,
+                                 num_reached)
+        # same counting convention as calc_ego_network_sizes, capped
+        # at the graph's size like the exact count (estimates overshoot)
+        sizes.append(np.minimum(num_reached + self_reachable + 1,
+                                adj_mat.num_nodes))
+
+    return [[(uid, i + 1, sizes[i][n].item()) for i in range(max_k)]
+            for n, uid in enumerate(node_ids)]
+
+
+def relative_errors(approx_results, exact_results):
+    """
+    per-K mean and max relative error of approximate sizes against
+    exact ones, for results in the same order
+    """
+    errors = {}
+    for approx, exact in zip(approx_results, exact_results):
+        for (_, k, size), (_, _, true_size) in zip(approx, exact):
+            errors.setdefault(k, []).append(abs(size - true_size) /
+                                            max(1, true_size))
+    return {k: (float(np.mean(e)), float(np.max(e)))
+            for k, e in sorted(errors.items())}
+
+
+if __name__ == "__main__":
+    # registers per counter: relative standard error ~ 1.04 / sqrt(2**log2m)
+    log2m = 8
+    max_k = 6
+    num_checked = 256  # players to also run the exact BFS for
+
+    ensure_graph_snapshot(node_file_path, edge_file_path, snapshot_path)
+    init_worker()
+    adj_mat = loaded_graph()
+    nodes = ego_networks.nodes
+    nodes_for_comparison = ego_networks.nodes_for_comparison
+
+    with instrument.stage('approx_ego_network_sizes') as info:
+        ego_results = approx_ego_network_sizes(nodes_for_comparison, max_k,
+                                               adj_mat, log2m)
+        info['items'] = len(nodes_for_comparison)
+
+    # measured error on a sample, next to the expected bound
+    exact = calc_ego_network_sizes_batch(nodes_for_comparison[:num_checked],
+                                         max_k, adj_mat)
+    print('expected relative standard error: {0:.1%}'.format(
+          1.04 / np.sqrt(1 << log2m)), file=sys.stderr)
+    for k, (mean_error, max_error) in relative_errors(
+            ego_results[:num_checked], exact).items():
+        print('K={0}: mean relative error {1:.2%}, max {2:.2%}'.format(
+              k, mean_error, max_error), file=sys.stderr)
+
+    # every player at once, so start the results over; nothing is stale
+    if os.path.exists(ego_networks.stale_file_path):
+        os.remove(ego_networks.stale_file_path)
+    with open('results/ego_results.csv', 'w') as file_out, \
+         open('results/processed_ego_ids.txt', 'w') as processed:
+        write_ego_results(ego_results, len(nodes), file_out, processed)
+
+    # with BUDA_PROFILE set, where the time went (see instrument.py)
+    instrument.write_summary()
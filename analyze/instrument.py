@@ -0,0 +1,252 @@
+"""
+opt-in instrumentation: timers and counters around the hot paths, and
+wall time, throughput and peak memory for each stage of a script
+
+set BUDA_PROFILE to a directory to turn it on, e.g.
+
+    BUDA_PROFILE=profile python similar_nodes.py
+
+every process, pool workers included, saves its timers and counters
+under that directory when it exits, and write_summary (called at the
+end of each script) merges them into <directory>/<script>-<pid>.json,
+along with how busy the pool workers were.  when BUDA_PROFILE isn't
+set, timed and task hand back the function untouched and timer, count
+and stage do nothing, so the instrumentation costs nothing
+
+profile_call runs one call under cProfile instead (see the --profile
+option of similar_nodes.py and ego_networks.py)
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import resource
+import cProfile
+import pstats
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import multiprocessing.util as util
+
+profile_dir = os.environ.get('BUDA_PROFILE')
+enabled = bool(profile_dir)
+
+# this process's measurements
+timer_calls = Counter()
+timer_seconds = Counter()
+task_names = set()  # timers that are pool tasks, for worker utilization
+counters = Counter()
+stages = []
+start_time = time.time()
+
+
+def reset():
+    """ forget this process's measurements (forked workers start empty) """
+    global start_time
+    for collection in (timer_calls, timer_seconds, counters):
+        collection.clear()
+    del stages[:]
+    start_time = time.time()
+
+
+def peak_rss_mb():
+    """ peak resident set size of this process so far, in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_id():
+    """
+    <script>-<pid> of the main process, shared with its workers
+    through the environment
+    """
+    if 'BUDA_PROFILE_RUN' not in os.environ:
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        os.environ['BUDA_PROFILE_RUN'] = '{0}-{1}'.format(script or 'python',
+                                                          os.getpid())
+    return os.environ['BUDA_PROFILE_RUN']
+
+
+def is_main_process():
+    return run_id().endswith('-' + str(os.getpid()))
+
+
+@contextmanager
+def timer(name):
+    """ add the time spent in the with block to timer name """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer_seconds[name] += time.perf_counter() - start
+        timer_calls[name] += 1
+
+
+def timed(name):
+    """ decorator: time every call of the function as timer name """
+    def decorator(function):
+        if not enabled:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer_seconds[name] += time.perf_counter() - start
+                timer_calls[name] += 1
+        return wrapper
+    return decorator
+
+
+def task(name):
+    """
+    decorator for the functions pool workers run: timed, and counted
+    as busy time when working out worker utilization
+    """
+    task_names.add(name)
+    return timed(name)
+
+
+def count(name, n=1):
+    """ add n to counter name """
+    if enabled:
+        counters[name] += int(n)
+
+
+@contextmanager
+def stage(name):
+    """
+    record the wall time and peak memory of a stage of a script.  the
+    with block gets a dict: set its 'items' to the number of things
+    the stage processed to get its throughput
+    """
+    info = {'name': name}
+    if not enabled:
+        yield info
+        return
+    start = time.perf_counter()
+    yield info
+    info['seconds'] = time.perf_counter() - start
+    if info.get('items') is not None and info['seconds'] > 0:
+        info['throughput'] = info['items'] / info['seconds']
+    info['peak_rss_mb'] = peak_rss_mb()
+    stages.append(info)
+
+
+def process_stats():
+    """ this process's measurements as a dict """
+    return {'pid': os.getpid(),
+            'main': is_main_process(),
+            'wall_seconds': time.time() - start_time,
+            'peak_rss_mb': peak_rss_mb(),
+            'timers': {name: [timer_calls[name], timer_seconds[name]]
+                       for name in timer_calls},
+            'tasks': sorted(task_names & set(timer_calls)),
+            'counters': dict(counters),
+            'stages': stages}
+
+
+def save_process_stats():
+    """ write this process's measurements to the run's directory """
+    if not enabled:
+        return
+    run_dir = os.path.join(profile_dir, run_id())
+    os.makedirs(run_dir, exist_ok=True)
+    file_name = os.path.join(run_dir, str(os.getpid()) + '.json')
+    with open(file_name + '.tmp', 'w') as file_out:
+        print(json.dumps(process_stats()), file=file_out)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def summarize(processes):
+    """ merge the measurements of a run's processes into one summary """
+    main = [stats for stats in processes if stats['main']]
+    workers = [stats for stats in processes if not stats['main']]
+
+    timers = {}
+    busy_seconds = 0.0
+    for stats in processes:
+        for name, (calls, seconds) in stats['timers'].items():
+            merged = timers.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            merged['calls'] += calls
+            merged['seconds'] += seconds
+            if not stats['main'] and name in stats['tasks']:
+                busy_seconds += seconds
+    for merged in timers.values():
+        merged['mean_ms'] = 1000 * merged['seconds'] / max(1, merged['calls'])
+
+    summary = {'run': run_id(),
+               'wall_seconds': main[0]['wall_seconds'] if main else None,
+               'peak_rss_mb': main[0]['peak_rss_mb'] if main else None,
+               'stages': main[0]['stages'] if main else [],
+               'timers': timers,
+               'counters': sum((Counter(stats['counters'])
+                                for stats in processes), Counter()),
+               'workers': len(workers)}
+
+    if workers:
+        summary['worker_peak_rss_mb'] = max(stats['peak_rss_mb']
+                                            for stats in workers)
+        summary['worker_busy_seconds'] = busy_seconds
+        # busy time over the time the pool was running batches
+        pool_seconds = sum(info['seconds'] for info in summary['stages']
+                           if info['name'] == 'run_batches')
+        if pool_seconds:
+            summary['worker_utilization'] = (busy_seconds /
+                                             (len(workers) * pool_seconds))
+    return summary
+
+
+def write_summary():
+    """
+    merge the measurements of this run's processes (call once the pool
+    has been joined) into <profile dir>/<run id>.json, and return the
+    summary
+    """
+    if not enabled:
+        return None
+    save_process_stats()
+    processes = []
+    for file_name in glob.glob(os.path.join(profile_dir, run_id(), '*.json')):
+        with open(file_name) as file_in:
+            processes.append(json.loads(file_in.read()))
+
+    summary = summarize(processes)
+    with open(os.path.join(profile_dir, run_id() + '.json'), 'w') as file_out:
+        print(json.dumps(summary, indent=1), file=file_out)
+    return summary
+
+
+def profile_call(file_name, function, *args, **kwargs):
+    """
+    run function(*args, **kwargs) under cProfile, dump the profile to
+    file_name (for pstats or snakeviz) and print the top entries by
+    cumulative time to stderr.  returns the function's result
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    profiler.dump_stats(file_name)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+        'cumulative').print_stats(25)
+    return result
+
+
+def start_worker(module=None):
+    """
+    start a worker process's measurements afresh, and save them when
+    it exits (multiprocessing drops the parent's exit hooks in children)
+    """
+    reset()
+    util.Finalize(None, save_process_stats, exitpriority=10)
+
+
+if enabled:
+    run_id()
+    util.Finalize(None, save_process_stats, exitpriority=10)
+    util.register_after_fork(sys.modules[__name__], start_worker)
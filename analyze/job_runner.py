@@ -0,0 +1,121 @@
+"""
+job runner shared by the long analyses (similar_nodes.py and
+ego_networks.py)
+
+batches of players are handed to the worker pool one at a time,
+costliest first, so whichever worker is free takes the next one and
+the cheap batches fill in at the end instead of a few big ones
+running alone.  each finished batch is checkpointed: its result rows
+are appended and synced before its player ids are, so after a crash or
+Ctrl-C, Checkpoint.recover can drop the rows of any batch whose ids
+never landed, and the next run redoes just those players
+"""
+
+import os
+import numpy as np
+from instrument import timer, stage
+
+
+def _trim_torn_line(file_name):
+    """ cut a partly written last line (no newline) off file_name """
+    if not os.path.exists(file_name):
+        return
+    with open(file_name, 'rb+') as file_in:
+        data = file_in.read()
+        if data and not data.endswith(b'\n'):
+            file_in.truncate(data.rfind(b'\n') + 1)
+
+
+def _append(file_name, text):
+    """ append text to file_name in one write, and sync it to disk """
+    with open(file_name, 'a') as file_out:
+        file_out.write(text)
+        file_out.flush()
+        os.fsync(file_out.fileno())
+
+
+class Checkpoint(object):
+    """
+    a results csv and its list of processed player ids, appended to a
+    batch at a time
+
+    row_keys(ids) gives the first-column values of the result rows of
+    a set of player ids (the ids themselves, or their labels)
+    """
+    def __init__(self, results_file_name, processed_file_name, row_keys):
+        self.results_file_name = results_file_name
+        self.processed_file_name = processed_file_name
+        self.row_keys = row_keys
+
+    def recover(self):
+        """
+        bring the files back to a batch boundary after an interrupted
+        run, and return the set of processed player ids
+        """
+        for file_name in (self.results_file_name, self.processed_file_name):
+            _trim_torn_line(file_name)
+
+        processed_ids = set()
+        if os.path.exists(self.processed_file_name):
+            with open(self.processed_file_name) as file_in:
+                processed_ids = set(int(line) for line in file_in
+                                    if line.strip())
+
+        # rows of a batch whose ids weren't checkpointed get redone
+        if os.path.exists(self.results_file_name):
+            keys = set(str(key).strip() for key in self.row_keys(processed_ids))
+            with open(self.results_file_name) as file_in:
+                lines = file_in.readlines()
+            kept = [line for line in lines
+                    if line.split(',')[0].strip() in keys]
+            if len(kept) < len(lines):
+                with open(self.results_file_name + '.tmp', 'w') as file_out:
+                    file_out.writelines(kept)
+                os.replace(self.results_file_name + '.tmp',
+                           self.results_file_name)
+        return processed_ids
+
+    def write(self, lines, ids):
+        """ checkpoint one finished batch: its result lines, then its ids """
+        if not ids:
+            return
+        _append(self.results_file_name, ''.join(lines))
+        _append(self.processed_file_name,
+                ''.join(str(uid) + '\n' for uid in ids))
+
+
+def order_by_cost(batches, costs):
+    """ batches sorted costliest first (ties keep their order) """
+    order = np.argsort(-np.asarray(costs, dtype=float), kind='stable')
+    return [batches[i] for i in order.tolist()]
+
+
+def run_batches(pool, function, batches, costs, checkpoint, format_result):
+    """
+    run function over every batch on pool, costliest batch first and
+    one batch per task, checkpointing each finished batch
+
+    function returns a list of results per batch; format_result turns
+    one (non-empty) result into its player id and csv lines.  if
+    anything goes wrong (including Ctrl-C) the pool is terminated, so no
+    half-finished batch is written
+    """
+    try:
+        with stage('run_batches') as info:
+            info['items'] = sum(len(batch) for batch in batches)
+            for batch_results in pool.imap(function,
+                                           order_by_cost(batches, costs),
+                                           chunksize=1):
+                with timer('write_results'):
+                    lines = []
+                    ids = []
+                    for result in batch_results:
+                        if not result:
+                            continue
+                        uid, result_lines = format_result(result)
+                        lines += result_lines
+                        ids.append(uid)
+                    checkpoint.write(lines, ids)
+    except BaseException:
+        pool.terminate()
+        raise
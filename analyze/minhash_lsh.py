@@ -0,0 +1,243 @@
+"""
+approximate similar-player search with weighted minhash and LSH
+
+each adjacency row gets a consistent weighted sampling (ICWS)
+signature, whose entries collide between two rows with probability
+equal to their weighted jaccard similarity. signatures are cut into
+bands and bucketed, and a query only re-ranks the players it shares a
+bucket with, using the exact jaccard + cosine score
+
+this is an experiment, not a mode of similar_nodes.py: on the current
+roster the exact block search there (two_hop_score_block) takes about
+0.4 ms per query, while the 32x1 index that recovers ~79% of the exact
+top 10 takes about 3 ms (collisions are looked up and re-ranked one
+query at a time, and single-row bands collide often).  it is kept to
+re-measure as the roster grows, when exact search stays O(candidates)
+per query and the index does not
+
+running this file prints a recall-vs-exact report for a few band/row
+settings, with the exact block search as the baseline to beat; the
+indexes are built in memory and not kept
+"""
+
+import sys
+import time
+import numpy as np
+from graph_functions import (ensure_graph_snapshot, open_graph_snapshot,
+                             read_candidate_ids, recent_ids_file_name,
+                             widen)
+from similarity_kernel import get_candidate_block, score_positions
+from top_k import top_k_indices
+
+# multiplier for mixing signature entries into a band key (FNV-1a prime)
+MIX = np.uint64(0x100000001B3)
+
+
+def icws_signatures(graph, num_hashes, seed=0, hashes_per_pass=8):
+    """
+    (num_nodes, num_hashes) int64 array of ICWS samples, one column per
+    hash: each sample packs the chosen neighbor and its quantized log
+    weight.  rows with no edges get -1 everywhere
+
+    the random draws are per (hash, neighbor) so samples are consistent
+    across rows; hashes are computed a few at a time to bound memory
+    """
+    rng = np.random.default_rng(seed)
+    shape = (num_hashes, graph.num_nodes)
+    gamma_r = rng.gamma(2.0, 1.0, shape)
+    log_c = np.log(rng.gamma(2.0, 1.0, shape))
+    beta = rng.uniform(0.0, 1.0, shape)
+
+    signatures = np.full((graph.num_nodes, num_hashes), -1, dtype=np.int64)
+    nonempty = np.flatnonzero(graph.degree() > 0)
+    if not len(nonempty):
+        return signatures
+    row_starts = graph.indptr[nonempty]
+    row_ids = graph.row_ids()
+    log_weights = np.log(graph.weights.astype(float))
+
+    for first in range(0, num_hashes, hashes_per_pass):
+        hashes = np.arange(first, min(first + hashes_per_pass, num_hashes))
+        r = gamma_r[hashes][:, graph.indices]
+        b = beta[hashes][:, graph.indices]
+        t = np.floor(log_weights / r + b)
+        # log of a = c / (y * exp(r)), with y = exp(r * (t - beta))
+        log_a = log_c[hashes][:, graph.indices] - r * (t - b) - r
+
+        # the first entry holding each row's minimum wins
+        row_min = np.minimum.reduceat(log_a, row_starts, axis=1)
+        for h in range(len(hashes)):
+            is_min = log_a[h] == np.repeat(row_min[h], graph.degree()[nonempty])
+            winners = np.flatnonzero(is_min)
+            rows, first_win = np.unique(row_ids[winners], return_index=True)
+            winners = winners[first_win]
+            signatures[rows, hashes[h]] = (widen(graph.indices[winners]) * 1000003 +
+                                           t[h, winners].astype(np.int64))
+    return signatures
+
+
+def band_keys(signatures, num_bands, rows_per_band):
+    """ (num_bands, num_nodes) uint64 keys mixing each band's entries """
+    keys = np.zeros((num_bands, len(signatures)), dtype=np.uint64)
+    for band in range(num_bands):
+        for col in range(band * rows_per_band, (band + 1) * rows_per_band):
+            keys[band] = (keys[band] ^ signatures[:, col].astype(np.uint64)) * MIX
+    return keys
+
+
+class LSHIndex(object):
+    """
+    LSH buckets over the band keys: for each band, the node rows sorted
+    by key, so one band's bucket is a searchsorted range
+    """
+    def __init__(self, keys, indexed, num_bands, rows_per_band):
+        self.keys = keys
+        self.indexed = indexed
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self.order = np.argsort(keys, axis=1, kind='stable')
+        self.sorted_keys = np.take_along_axis(keys, self.order, axis=1)
+
+    def collisions(self, row):
+        """ matrix rows sharing at least one bucket with row (incl. row) """
+        if not self.indexed[row]:
+            return np.zeros(0, dtype=np.int64)
+        members = []
+        for band in range(self.num_bands):
+            key = self.keys[band, row]
+            lo = np.searchsorted(self.sorted_keys[band], key, side='left')
+            hi = np.searchsorted(self.sorted_keys[band], key, side='right')
+            members.append(self.order[band, lo:hi])
+        return np.unique(np.concatenate(members))
+
+
+def build_lsh_index(graph, num_bands=16, rows_per_band=2, seed=0,
+                    signatures=None):
+    """
+    build an LSHIndex for graph.  signatures (from icws_signatures with
+    at least num_bands * rows_per_band hashes and the same seed) can be
+    passed in to try several band settings without resampling
+    """
+    num_hashes = num_bands * rows_per_band
+    if signatures is None:
+        signatures = icws_signatures(graph, num_hashes, seed)
+    keys = band_keys(signatures[:, :num_hashes], num_bands, rows_per_band)
+    return LSHIndex(keys, graph.degree() > 0, num_bands, rows_per_band)
+
+
+def find_missing_edges_approx(node_id, index, candidate_ids, adj_mat,
+                              num_to_find=10, node_thresh=1):
+    """
+    approximate find_missing_edges: only candidates sharing an LSH
+    bucket with node_id are scored (exactly), so players the index
+    misses are never recommended, and there is no zero-score fill: the
+    list is padded with (node_id, node_id, -inf) instead
+
+    returns NODE IDs (not matrix indices) and similarity scores
+    """
+    uid = node_id
+    if adj_mat.weighted_degrees[uid - 1] < node_thresh:
+        return None
+
+    block = get_candidate_block(adj_mat, candidate_ids)
+    collisions = index.collisions(uid - 1)
+    positions = block.positions[collisions]
+
+    # only want unconnected candidates other than the query itself
+    connected = np.zeros(adj_mat.num_nodes, dtype=bool)
+    connected[adj_mat.neighbors(uid - 1)] = True
+    connected[uid - 1] = True
+    positions = np.sort(positions[(positions >= 0) & ~connected[collisions]])
+
+    scores = score_positions(adj_mat, uid - 1, block, positions)
+    best = top_k_indices(scores, num_to_find)
+    missing_edges = [(uid, uid2, sim) for uid2, sim in
+                     zip(block.ids[positions[best]].tolist(),
+                         scores[best].tolist())]
+    missing_edges += [(uid, uid, float('-inf'))
+                      for n in range(num_to_find - len(missing_edges))]
+    return missing_edges
+
+
+def recall_report(index, candidate_ids, adj_mat, exact_results,
+                  num_to_find=10):
+    """
+    compare approximate results against exact ones, a dict of node id
+    to find_missing_edges results.  recall is the share of each exact
+    top-k (ignoring zero-score fill) the approximate search recovers
+
+    returns a dict of mean recall, mean candidates re-ranked per query
+    and seconds per query
+    """
+    recalls = []
+    reranked = []
+    start = time.time()
+    for uid, exact in exact_results.items():
+        relevant = set(uid2 for _, uid2, sim in exact if sim > 0)
+        if not relevant:
+            continue
+        approx = find_missing_edges_approx(uid, index, candidate_ids,
+                                           adj_mat, num_to_find)
+        found = set(uid2 for _, uid2, sim in approx if sim > float('-inf'))
+        recalls.append(len(relevant & found) / len(relevant))
+        reranked.append(len(index.collisions(uid - 1)))
+
+    return {'recall': float(np.mean(recalls)) if recalls else 0.0,
+            'reranked': float(np.mean(reranked)) if reranked else 0.0,
+            'seconds_per_query': (time.time() - start) / max(1, len(recalls))}
+
+
+if __name__ == "__main__":
+    # import here so the index can be used without the similarity script
+    from similar_nodes import find_missing_edges, find_missing_edges_block
+    from similarity_kernel import plan_query_blocks
+
+    node_file_path = '../data/player_graph/nodes.csv'
+    edge_file_path = '../data/player_graph/edges.csv'
+    candidate_file_path = recent_ids_file_name()
+    snapshot_path = '../data/player_graph/snapshot'
+
+    # band/row settings to compare.  recommended pairs have weighted
+    # jaccard around 0.05-0.1, so single-row bands are needed to catch
+    # them at all
+    settings = [(8, 1), (16, 1), (32, 1), (64, 1), (32, 2), (64, 2)]
+    num_queries = 500
+    seed = 0
+
+    ensure_graph_snapshot(node_file_path, edge_file_path, snapshot_path)
+    adj_mat, nodes = open_graph_snapshot(snapshot_path)
+    candidate_ids = read_candidate_ids(candidate_file_path)
+
+    max_hashes = max(bands * rows for bands, rows in settings)
+    signatures = icws_signatures(adj_mat, max_hashes, seed)
+
+    # exact results to measure against, one query at a time and in the
+    # blocks similar_nodes.py runs
+    queries = candidate_ids[:num_queries]
+    start = time.time()
+    exact_results = {}
+    for uid in queries:
+        result = find_missing_edges(uid, candidate_ids, adj_mat)
+        if result:
+            exact_results[uid] = result
+    exact_seconds = (time.time() - start) / max(1, len(exact_results))
+
+    start = time.time()
+    block = get_candidate_block(adj_mat, candidate_ids)
+    for rows in plan_query_blocks(adj_mat, [x - 1 for x in queries], block):
+        find_missing_edges_block([x + 1 for x in rows], candidate_ids,
+                                 adj_mat)
+    block_seconds = (time.time() - start) / max(1, len(exact_results))
+
+    print('bands,rows,recall,reranked_per_query,ms_per_query')
+    print('exact', '', 1.0, len(candidate_ids), round(1000 * exact_seconds, 3),
+          sep=',')
+    print('exact block', '', 1.0, len(candidate_ids),
+          round(1000 * block_seconds, 3), sep=',')
+    for bands, rows in settings:
+        index = build_lsh_index(adj_mat, bands, rows, seed, signatures)
+        report = recall_report(index, candidate_ids, adj_mat, exact_results)
+        print(bands, rows, round(report['recall'], 4),
+              round(report['reranked'], 1),
+              round(1000 * report['seconds_per_query'], 3), sep=',')
+        sys.stdout.flush()
@@ -2,58 +2,137 @@
 compute basic statistics about a network:
 distributions of node degree, weighted degree,
 edge_weight
+
+everything is a reduction over the CSR arrays, and distributions come
+back binned (counts per bin) rather than as one entry per node or edge,
+so the plots below only draw precomputed bars
 """
 
-import numpy as np
-from graph_functions import load_adjacency_matrix
-import aperture as ap
-import matplotlib.pyplot as plt
 import json
+import numpy as np
+from graph_functions import load_graph
 
-def calc_node_degree(adj_mat):
+def calc_node_degree(graph):
     """ return a list of each node's degree """
-    return np.apply_along_axis(lambda x: len(x[x > 0]), 1, adj_mat)
+    return graph.degree()
 
 
-def calc_weighted_node_degree(adj_mat):
+def calc_weighted_node_degree(graph):
     """ return a list of each node's WEIGHTED degree """
-    return np.sum(adj_mat, axis=1)
+    return graph.weighted_degrees
 
 
-def get_edge_weight_list(adj_mat):
+def get_edge_weight_list(graph):
     """ return a list of the positive edge weights """
-    edge_weights = []
-    for i, row in enumerate(adj_mat):
-        for j, el in enumerate(row):
-            if j <= i or not el:
-                continue
-            edge_weights.append(el)
-    return edge_weights
+    upper = graph.indices > graph.row_ids()  # each undirected edge once
+    return graph.weights[upper & (graph.weights > 0)]
 
 
 def mean_pos_edge_weight(array):
-    """ return mean of the positive elements of array """    
-    return np.mean(array[array > 0]) if any(array) else 0
+    """ return mean of the positive elements of array """
+    positive = array > 0
+    return array.sum(where=positive) / positive.sum() if positive.any() else 0
 
 
-def calc_mean_edge_weight(adj_mat):
+def calc_mean_edge_weight(graph):
     """ return a list of each node's mean positive edge weight """
-    return np.apply_along_axis(mean_pos_edge_weight, 1, adj_mat)
+    degrees = calc_node_degree(graph)
+    weighted_degrees = calc_weighted_node_degree(graph)
+    return np.divide(weighted_degrees, degrees,
+                     out=np.zeros(graph.num_nodes), where=degrees > 0)
+
+
+def binned_counts(values, bins):
+    """
+    histogram of values over the bin edges in bins, like np.histogram
+    (the last bin includes its right edge): returns (counts, edges).
+    unit-width integer bins, the usual case here, are counted with a
+    single bincount instead of a search per value
+    """
+    edges = np.asarray(bins)
+    values = np.asarray(values)
+    unit_bins = (edges.dtype.kind in 'iu' and values.dtype.kind in 'iu' and
+                 len(edges) > 1 and (np.diff(edges) == 1).all())
+    if not unit_bins:
+        return np.histogram(values, bins=edges)
+
+    first, last = int(edges[0]), int(edges[-1])
+    inside = values[(values >= first) & (values <= last)] - first
+    counts = np.bincount(inside, minlength=last - first + 1)
+    counts[-2] += counts[-1]  # right edge of the last bin
+    return counts[:-1], edges
+
+
+def summarize(values):
+    """ count, mean, median and extremes of an array as a dict """
+    if not len(values):
+        return {'count': 0}
+    return {'count': int(len(values)),
+            'mean': float(np.mean(values)),
+            'median': float(np.median(values)),
+            'min': values.min().item(),
+            'max': values.max().item()}
+
+
+def network_stats(graph, degree_bins=range(1000), weight_bins=range(100),
+                  weighted_degree_bins=50):
+    """
+    summary statistics and binned distributions of node degree,
+    weighted degree, per-node mean edge weight and edge weight, as a
+    dict of plain lists and numbers (ready for json)
+
+    each *_bins is a sequence of bin edges, or a number of equal bins
+    """
+    degrees = calc_node_degree(graph)
+    weighted_degrees = calc_weighted_node_degree(graph)
+    mean_edge_weights = calc_mean_edge_weight(graph)
+    edge_weights = get_edge_weight_list(graph)
+
+    stats = {'num_nodes': int(graph.num_nodes),
+             'num_edges': int(len(edge_weights)),
+             'mean_pos_edge_weight': float(mean_pos_edge_weight(edge_weights))}
+    for name, values, bins in (
+            ('node_degree', degrees, degree_bins),
+            ('weighted_node_degree', weighted_degrees, weighted_degree_bins),
+            ('mean_edge_weight', mean_edge_weights[degrees > 0], 50),
+            ('edge_weight', edge_weights, weight_bins)):
+        if isinstance(bins, int):
+            bins = np.histogram_bin_edges(values, bins)
+        counts, edges = binned_counts(values, bins)
+        stats[name] = summarize(values)
+        stats[name]['histogram'] = {'counts': counts.tolist(),
+                                    'edges': edges.tolist()}
+    return stats
+
+
+def plot_histogram(histogram, **kwargs):
+    """ draw a binned histogram from network_stats on the current axes """
+    import matplotlib.pyplot as plt
+    edges = np.asarray(histogram['edges'])
+    plt.bar(edges[:-1], histogram['counts'], width=np.diff(edges),
+            align='edge', **kwargs)
 
 
 if __name__ == "__main__":
     node_file_path = '../data/player_graph/nodes.csv'
     edge_file_path = '../data/player_graph/edges.csv'
+    snapshot_path = '../data/player_graph/snapshot'
 
-    # player graph as adjacency matrix
-    adj_mat, nodes = load_adjacency_matrix(node_file_path,
-                                           edge_file_path)
+    # player graph as compressed sparse rows
+    graph, nodes = load_graph(node_file_path, edge_file_path, snapshot_path)
 
     # basic analytics
-    node_degrees = calc_node_degree(adj_mat)
-    weighted_node_degrees = calc_weighted_node_degree(adj_mat)
-    mean_edge_weights = calc_mean_edge_weight(adj_mat)
-    edge_weight_list = get_edge_weight_list(adj_mat)
+    stats = network_stats(graph)
+    with open('results/network_stats.json', 'w') as file_out:
+        print(json.dumps(stats), file=file_out)
+
+    # plotting only from here on
+    import aperture as ap
+    import matplotlib.pyplot as plt
+
+    node_degrees = calc_node_degree(graph)
+    weighted_node_degrees = calc_weighted_node_degree(graph)
+    mean_edge_weights = calc_mean_edge_weight(graph)
 
     # get ego results for degrees 1 and 2 (from json'd file):
     ego_json_file = '../app/egos.json'
@@ -82,8 +161,8 @@ if __name__ == "__main__":
 
     # plot node degree hist
     fig = plt.figure()
-    plt.hist(node_degrees, bins=range(1000), log=False,
-             facecolor=ap.solarized('blue'), edgecolor=ap.solarized('blue'))
+    plot_histogram(stats['node_degree']['histogram'], log=False,
+                   facecolor=ap.solarized('blue'), edgecolor=ap.solarized('blue'))
     fig.gca().set_xlim([0, 300])
     plt.xlabel('Number of distinct teammates')
     plt.ylabel('Player count')
@@ -91,8 +170,8 @@ if __name__ == "__main__":
 
     # plot edge weight hist
     fig = plt.figure()
-    plt.hist(edge_weight_list, bins=range(100), log=True,
-             facecolor=ap.solarized('blue'), edgecolor=ap.solarized('blue'))
+    plot_histogram(stats['edge_weight']['histogram'], log=True,
+                   facecolor=ap.solarized('blue'), edgecolor=ap.solarized('blue'))
     fig.gca().set_xlim([0, 70])
     fig.gca().set_ylim([0.5, 1e6])
     plt.xlabel('Times two given players played together')
@@ -2,142 +2,266 @@
 find similar nodes in a graph using jaccard similarity
 and cosine similarity
 
-use multiprocessing because n^3 comparison
-of each node to every other is very slow
+the whole recommendation table is computed in blocks of
+players at a time, as sparse matrix products over shared
+teammates, with multiprocessing across the blocks
 
 """
 
+import sys
+import os
 import math
 import numpy as np
-import ctypes
-from operator import itemgetter
 from functools import partial
-from multiprocessing import Pool, cpu_count
-import multiprocessing.util as util
-from graph_functions import load_adj_mat_multiproc
+from multiprocessing import get_context
+from graph_functions import (ensure_graph_snapshot, open_graph_snapshot,
+                             read_candidate_ids, read_id_file, drop_results,
+                             share_graph, attach_shared_graph,
+                             recent_ids_file_name, default_num_workers,
+                             pool_start_method, use_compact_graph)
+from job_runner import Checkpoint, run_batches
+from similarity_kernel import (get_candidate_block, two_hop_scores,
+                               two_hop_score_block, plan_query_blocks,
+                               two_hop_work)
+from top_k import top_k_indices, top_k_rows
+import instrument
 
-#==============================================================================
-# Global variable shenanigans to get numpy to play nice with multiprocessing
 node_file_path = '../data/player_graph/nodes.csv'
 edge_file_path = '../data/player_graph/edges.csv'
-candidate_file_path = '../data/player_graph/node_ids_since_2013.txt'
-
-# adjacency matrix and dict of node id/label
-adj_mat_base, adj_mat, nodes = load_adj_mat_multiproc(node_file_path,
-                                                      edge_file_path)
-
-# node IDs range from 1 to the number of nodes
-nodes_for_comparison = []
-with open(candidate_file_path) as cand_file:
-    for line in cand_file:
-        nodes_for_comparison.append(int(line))
-#==============================================================================
-
-
-def jaccard_similarity(vector_one, vector_two):
+candidate_file_path = recent_ids_file_name()
+snapshot_path = '../data/player_graph/snapshot'
+stale_file_path = '../data/player_graph/stale_similarity_ids.txt'
+
+# recommendations per player (env BUDA_NUM_TO_FIND)
+num_to_find = int(os.environ.get('BUDA_NUM_TO_FIND', 10))
+
+# load the graph in compact dtypes (env BUDA_COMPACT_GRAPH=1): a fraction
+# of the memory (here and in the shared copy the workers use), same results
+compact_graph_arrays = use_compact_graph()
+
+# per-process graph state: adjacency matrix as a CSRGraph, dict of node
+# id/label and the node ids to process. loaded by init_worker, not at
+# import, so the scoring functions can be imported without the data files
+adj_mat = None
+nodes = None
+nodes_for_comparison = None
+shared_graph = None  # the SharedGraph adj_mat lives in, in pool workers
+
+def init_worker(snapshot_dir=snapshot_path,
+                candidate_file_name=candidate_file_path, graph_handle=None,
+                compact=False):
     """
-    weighted jaccard similarity between two vectors:
-    jaccard similarity is len(intersection(x,y))/len(union(x,y))
-    for weighted version against indexed vectors it's sum(min) / sum(max)
+    load the graph snapshot and candidate ids into this process.
+    used as the Pool initializer: each worker memory-maps the same
+    snapshot, whether it was started by fork, spawn or forkserver
+
+    given the handle of a SharedGraph, workers attach to its shared
+    memory instead (and leave nodes unset, as only the parent writes
+    results).  if compact, the snapshot is copied into the smallest
+    dtypes that hold it (see graph_functions.compact_graph); a shared
+    graph keeps whatever dtypes it was shared with
     """
-    vec_min = (min(i, j) for i, j in zip(vector_one, vector_two))
-    vec_max = (max(i, j) for i, j in zip(vector_one, vector_two))
-    return sum(vec_min) / max(1, sum(vec_max))  # prevent div by zero
+    global adj_mat, nodes, nodes_for_comparison, shared_graph
+    if graph_handle is None:
+        adj_mat, nodes = open_graph_snapshot(snapshot_dir, compact=compact)
+    else:
+        shared_graph = attach_shared_graph(graph_handle)
+        adj_mat = shared_graph.graph
+    nodes_for_comparison = read_candidate_ids(candidate_file_name)
 
 
-def cosine_similarity(vector_one, vector_two):
-    """
-    cosine similarity between two vectors
-    """
-    vec_one_norm = max(1, np.linalg.norm(vector_one))
-    vec_two_norm = max(1, np.linalg.norm(vector_two))
-    return np.dot(vector_one, vector_two) / max(1, vec_one_norm * vec_two_norm)
+def loaded_graph():
+    """ the graph loaded into this process by init_worker """
+    if adj_mat is None:
+        raise RuntimeError('no graph loaded: call init_worker first')
+    return adj_mat
 
 
-def find_missing_edges(node_id, candidate_ids=nodes_for_comparison,
-                       adj_mat=adj_mat, num_to_find=10, node_thresh=1):
+def find_missing_edges(node_id, candidate_ids=None, adj_mat=None,
+                       num_to_find=10, node_thresh=1):
     """
     find the most similar nodes that don't share an edge with node_id
 
     candidate_ids is a list of node ids which we want to recommend for
+        (defaults to the ids loaded by init_worker)
 
-    adj_mat is the adjacency matrix as a numpy array,
-        element ij is the weight between
-    nodes with id i+1 and j+1 (because matrices are zero-indexed)
+    adj_mat is the adjacency matrix as a CSRGraph (defaults to the
+        graph loaded by init_worker),
+        row i holds the weights between
+    node with id i+1 and its neighbors (because matrices are zero-indexed)
 
     node_id is a specific node id to find recommendations for
     num_to_find is the number of recommendations to make
     node_thresh filters on node weighted degree - i.e. dont search small nodes
 
+    only candidates within two hops of node_id (sharing a teammate)
+    can score above zero, so only those are scored, in one batch by
+    similarity_kernel, and the best are picked with top_k_indices
+    (ties go to the candidate listed first).  if fewer than num_to_find
+    score above zero, the rest are filled with zero-score candidates in
+    list order, exactly as a scan of every candidate would; if there are
+    fewer than num_to_find unconnected candidates at all, the list is
+    padded with (node_id, node_id, -inf)
+
     returns NODE IDs (not matrix indices) and similarity scores
     """
-    N = len(adj_mat)
+    if adj_mat is None:
+        adj_mat = loaded_graph()
+    if candidate_ids is None:
+        candidate_ids = nodes_for_comparison
     uid = node_id
 
     # tuples of uid1,uid2,similarity
     missing_edges = None
 
-    node_one_vec = adj_mat[uid - 1, :]
+    if adj_mat.weighted_degrees[uid - 1] >= node_thresh:
+        block = get_candidate_block(adj_mat, candidate_ids)
+
+        # only want unconnected nodes, and only those sharing a teammate
+        # can be similar at all
+        positions, scores = two_hop_scores(adj_mat, uid - 1, block)
+        instrument.count('pairs_scored', len(positions))
+        instrument.count('pairs_pruned', len(block) - len(positions))
+
+        best = top_k_indices(scores, num_to_find)
+        missing_edges = [(uid, uid2, sim) for uid2, sim in
+                         zip(block.ids[positions[best]].tolist(),
+                             scores[best].tolist())]
+
+        if len(missing_edges) < num_to_find:
+            # zero-score fill: unconnected candidates beyond two hops
+            connected = block.positions[np.append(adj_mat.neighbors(uid - 1),
+                                                  uid - 1)]
+            filler = np.ones(len(block), dtype=bool)
+            filler[positions] = False
+            filler[connected[connected >= 0]] = False
+            missing_edges += [(uid, uid2, 0.0) for uid2 in
+                              block.ids[np.flatnonzero(filler)]
+                              [:num_to_find - len(missing_edges)].tolist()]
+
+        missing_edges += [(uid, uid, float('-inf'))
+                          for n in range(num_to_find - len(missing_edges))]
 
-    if sum(node_one_vec) >= node_thresh:
-        missing_edges = [(uid, uid, float('-inf')) for n in range(num_to_find)]
-        for uid2 in candidate_ids:
-            # only want unconnected nodes
-            if node_one_vec[uid2 - 1] or uid == uid2:
-                continue
+    return missing_edges
 
-            node_two_vec = adj_mat[uid2 - 1, :]
 
-            sim = (jaccard_similarity(node_one_vec, node_two_vec) +
-                   cosine_similarity(node_one_vec, node_two_vec))
+@instrument.task('similarity_task')
+def find_missing_edges_block(node_ids, candidate_ids=None, adj_mat=None,
+                             num_to_find=10, node_thresh=1):
+    """
+    find_missing_edges for a block of node ids at once: the block is
+    scored against every candidate by two_hop_score_block, which masks
+    out existing edges, and the top num_to_find of each row are picked
+    with top_k_rows, with the same tie-breaking and padding
 
-            if sim >= missing_edges[-1][2]:
-                # get rid of the least-similar entry in list
-                missing_edges[-1] = (uid, uid2, sim)
-                missing_edges.sort(key=itemgetter(2), reverse=True)
+    memory is len(node_ids) * len(candidate_ids) scores plus the
+    block's two-hop steps; plan_query_blocks bounds both
 
-    return missing_edges
+    returns a list of find_missing_edges results, one per node id
+    """
+    if adj_mat is None:
+        adj_mat = loaded_graph()
+    if candidate_ids is None:
+        candidate_ids = nodes_for_comparison
+    block = get_candidate_block(adj_mat, candidate_ids)
+
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    searched = adj_mat.weighted_degrees[node_ids - 1] >= node_thresh
+    rows = node_ids[searched] - 1
+
+    scores = two_hop_score_block(adj_mat, rows, block)
+    instrument.count('similarity_queries', len(rows))
+    if instrument.enabled:
+        # candidates sharing a teammate, out of all the pairs
+        scored = np.count_nonzero(scores > 0)
+        instrument.count('pairs_scored', scored)
+        instrument.count('pairs_pruned', scores.size - scored)
+    best = top_k_rows(scores, num_to_find)
+    best_scores = np.take_along_axis(scores, best, axis=1).tolist()
+    best_ids = block.ids[best].tolist()
+
+    results = [None for uid in node_ids]
+    for n, i in enumerate(np.flatnonzero(searched).tolist()):
+        uid = int(node_ids[i])
+        missing_edges = [(uid, uid2, sim) if sim != float('-inf')
+                         else (uid, uid, sim)
+                         for uid2, sim in zip(best_ids[n], best_scores[n])]
+        missing_edges += [(uid, uid, float('-inf'))
+                          for m in range(num_to_find - len(missing_edges))]
+        results[i] = missing_edges
+    return results
+
+
+def format_similarity_result(result):
+    """
+    a find_missing_edges result as its node id and its csv lines of
+    player label, recommended player label and score
+    """
+    return result[0][0], ['{0},{1},{2}\n'.format(nodes[uid], nodes[uid2],
+                                                round(sim, 2))
+                          for (uid, uid2, sim) in result]
 
 
 if __name__ == "__main__":
-    # load node id's that we have already processed
-    processed_ids = set()
-    try:
-        with open('results/processed_similarity_ids.txt') as file_in:
-            for line in file_in:
-                processed_ids.add(int(line))
-    except:
-        pass
+    # compile the snapshot once so every worker can just map it
+    with instrument.stage('load_graph'):
+        ensure_graph_snapshot(node_file_path, edge_file_path, snapshot_path)
+        init_worker(compact=compact_graph_arrays)
+
+    # load node id's that we have already processed, first undoing
+    # any batch an interrupted run didn't finish writing
+    checkpoint = Checkpoint('results/similarity_results.csv',
+                            'results/processed_similarity_ids.txt',
+                            lambda ids: [nodes[uid] for uid in ids])
+    processed_ids = checkpoint.recover()
+
+    # recompute the players a new season made stale (see temporal_graph.py)
+    stale_ids = read_id_file(stale_file_path)
+    if stale_ids:
+        drop_results('results/similarity_results.csv',
+                     'results/processed_similarity_ids.txt',
+                     [nodes[uid] for uid in stale_ids], stale_ids)
+        processed_ids -= stale_ids
+    if os.path.exists(stale_file_path):
+        os.remove(stale_file_path)
 
     # process the rest
     nodes_to_process = [x for x in nodes_for_comparison if x not in processed_ids]
 
-    # parallel generation of results
-    util.log_to_stderr(util.SUBDEBUG)
-    n_cores = cpu_count()
-    chunksize = max(1, len(nodes_to_process) // (2 * (n_cores - 1)))
-
-    
-    pool = Pool(processes=(n_cores - 1))
-    similarity_results = pool.imap(find_missing_edges,
-                                   nodes_to_process,
-                                   chunksize=chunksize)
-
-    # write results to file
-    with open('results/similarity_results.csv', 'a') as file_out, \
-         open('results/processed_similarity_ids.txt', 'a') as processed:
-        for result in similarity_results:
-            if not result:
-                continue
-            # write the result
-            for (uid, uid2, sim) in result:
-                print(nodes[uid], nodes[uid2], round(sim, 2),
-                      sep=',', file=file_out)
-            # log that we have another result
-            print(uid, file=processed)
+    # blocks of players to score together, sized to bound memory, and
+    # their cost in two-hop steps
+    block = get_candidate_block(adj_mat, nodes_for_comparison)
+    batches = [[row + 1 for row in batch] for batch in
+               plan_query_blocks(adj_mat, [x - 1 for x in nodes_to_process],
+                                 block)]
+    work = two_hop_work(adj_mat, block)
+    costs = [int(work[np.array(batch) - 1].sum()) for batch in batches]
+
+    # python similar_nodes.py --profile [node id]: run one task (that
+    # player's, or the costliest batch) under cProfile and stop there
+    if '--profile' in sys.argv[1:]:
+        args = sys.argv[sys.argv.index('--profile') + 1:]
+        batch = [int(args[0])] if args else batches[int(np.argmax(costs))]
+        instrument.profile_call('results/similarity_task.prof',
+                                find_missing_edges_block, batch,
+                                num_to_find=num_to_find)
+        sys.exit()
+
+    # parallel generation of results: workers attach to one shared copy
+    # of the graph in init_worker, so any start method works (env
+    # BUDA_START_METHOD); this process unlinks it when done
+    shared = share_graph(adj_mat)
+    pool = get_context(pool_start_method()).Pool(
+        processes=default_num_workers(), initializer=init_worker,
+        initargs=(snapshot_path, candidate_file_path, shared.handle))
+
+    # write results to file, a batch at a time
+    run_batches(pool, partial(find_missing_edges_block, num_to_find=num_to_find),
+                batches, costs, checkpoint, format_similarity_result)
 
     pool.close()
     pool.join()
+    shared.close()
 
-
-
+    # with BUDA_PROFILE set, where the time went (see instrument.py)
+    instrument.write_summary()
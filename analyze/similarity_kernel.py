@@ -0,0 +1,224 @@
+"""
+batched jaccard + cosine similarity scoring against a CSRGraph
+
+instead of zipping two full rows per pair, the candidate rows are
+gathered into one contiguous block once, along with its transpose, and
+a query only visits the candidates it shares a teammate with.
+two_hop_score_block computes the scores of a whole block of queries at
+once as a sparse A*A^T product over shared teammates
+"""
+
+import numpy as np
+from graph_functions import segment_sums, gather_positions, widen
+
+
+class CandidateBlock(object):
+    """
+    the CSR rows of a list of candidate node ids, gathered into one
+    block, along with each row's cached weight sum and L2 norm from the
+    graph
+    """
+    def __init__(self, graph, candidate_ids):
+        self.ids = np.asarray(candidate_ids, dtype=np.int64)
+        rows = self.ids - 1
+        entries, lengths = graph.entry_positions(rows)
+
+        # widened, so scoring arithmetic can't overflow a compact graph's
+        # small dtypes
+        self.indices = widen(graph.indices[entries])
+        self.weights = widen(graph.weights[entries])
+
+        self.sums = widen(graph.weighted_degrees[rows])
+        self.norms = widen(graph.norms[rows])
+
+        # position in the block of each matrix row, -1 if not a candidate
+        self.positions = np.full(graph.num_nodes, -1, dtype=np.int64)
+        self.positions[rows] = np.arange(len(rows))
+
+        # the block transposed: for each matrix row (teammate), the block
+        # positions of the candidates it played with and the edge weights
+        owners = np.repeat(np.arange(len(rows)), lengths)
+        order = np.argsort(self.indices, kind='stable')
+        self.teammate_indptr = np.zeros(graph.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=graph.num_nodes),
+                  out=self.teammate_indptr[1:])
+        self.teammate_positions = owners[order]
+        self.teammate_weights = self.weights[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+_block_cache = {}
+
+
+def get_candidate_block(graph, candidate_ids):
+    """
+    CandidateBlock for candidate_ids, reused across calls for as long
+    as the same graph and candidate list objects are passed in
+    """
+    key = (id(graph), id(candidate_ids))
+    cached = _block_cache.get(key)
+    if cached is None or cached[0] is not graph or cached[1] is not candidate_ids:
+        _block_cache.clear()
+        cached = (graph, candidate_ids, CandidateBlock(graph, candidate_ids))
+        _block_cache[key] = cached
+    return cached[2]
+
+
+def two_hop_scores(graph, row, block):
+    """
+    jaccard + cosine similarity between matrix row <row> and the
+    candidates within two hops of it, i.e. sharing at least one teammate
+    with it: every other candidate has a zero weighted-jaccard numerator
+    and dot product, so scores zero
+
+    instead of scanning candidate rows, walk from the query through
+    each of its neighbors: every step query -> n -> c adds
+    min(q_n, c_n) and q_n * c_n for candidate c, so the work is the sum
+    of the query's neighbors' degrees rather than the size of the block
+
+    returns the block positions of those candidates, in candidate order,
+    excluding the query itself and its neighbors, and their scores
+    """
+    query_indices, query_weights = graph.row(row)
+    entries, lengths = gather_positions(block.teammate_indptr, query_indices)
+    reached = block.teammate_positions[entries]
+    via = np.repeat(query_weights, lengths)
+    weights = block.teammate_weights[entries]
+
+    # integer-valued float sums, exact well past any realistic weight
+    sum_min = np.bincount(reached, weights=np.minimum(via, weights),
+                          minlength=len(block))
+    dot = np.bincount(reached, weights=via * weights, minlength=len(block))
+
+    # drop the query and the candidates it already shares an edge with
+    connected = block.positions[np.append(query_indices, row)]
+    sum_min[connected[connected >= 0]] = 0
+
+    positions = np.flatnonzero(sum_min)
+    sum_min, dot = sum_min[positions], dot[positions]
+
+    sum_max = graph.weighted_degrees[row] + block.sums[positions] - sum_min
+    jaccard = sum_min / np.maximum(1, sum_max)
+
+    query_norm = max(1, graph.norms[row])
+    cosine = dot / np.maximum(1, query_norm *
+                              np.maximum(1, block.norms[positions]))
+    return positions, jaccard + cosine
+
+
+def score_positions(graph, row, block, positions):
+    """
+    jaccard + cosine similarity between matrix row <row> and the
+    candidates at the given block positions, without touching the rest
+    of the block
+    """
+    query_indices, query_weights = graph.row(row)
+    query = np.zeros(graph.num_nodes, dtype=block.weights.dtype)
+    query[query_indices] = query_weights
+
+    entries, lengths = graph.entry_positions(block.ids[positions] - 1)
+    indptr = np.zeros(len(positions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+
+    hits = query[graph.indices[entries]]
+    weights = graph.weights[entries]
+    sum_min = segment_sums(np.minimum(hits, weights), indptr)
+    dot = segment_sums(hits * weights, indptr)
+
+    sum_max = graph.weighted_degrees[row] + block.sums[positions] - sum_min
+    jaccard = sum_min / np.maximum(1, sum_max)
+
+    query_norm = max(1, graph.norms[row])
+    cosine = dot / np.maximum(1, query_norm *
+                              np.maximum(1, block.norms[positions]))
+    return jaccard + cosine
+
+
+def two_hop_work(graph, block):
+    """
+    number of query -> teammate -> candidate steps two_hop_scores takes
+    for each matrix row: the number of candidates among its neighbors'
+    neighbors, counted with multiplicity
+    """
+    candidate_degrees = np.diff(block.teammate_indptr)
+    return segment_sums(candidate_degrees[graph.indices], graph.indptr)
+
+
+def plan_query_blocks(graph, rows, block, max_steps=100000, max_rows=128):
+    """
+    split rows, in order, into blocks of at most max_rows rows whose
+    total two_hop_work stays under max_steps (a single heavier row gets
+    a block of its own), bounding the memory two_hop_score_block needs
+    per block: the per-step arrays grow with the steps, and the dense
+    (rows, candidates) score arrays with the rows.  the default steps
+    keep each per-step array around a megabyte, which measured faster
+    than larger blocks
+    """
+    work = two_hop_work(graph, block)[np.asarray(rows, dtype=np.int64)].tolist()
+    blocks = []
+    this_block = []
+    block_steps = 0
+    for row, steps in zip(rows, work):
+        if this_block and (block_steps + steps > max_steps or
+                           len(this_block) == max_rows):
+            blocks.append(this_block)
+            this_block = []
+            block_steps = 0
+        this_block.append(row)
+        block_steps += steps
+    if this_block:
+        blocks.append(this_block)
+    return blocks
+
+
+def two_hop_score_block(graph, rows, block):
+    """
+    scores of a block of query rows against every candidate in block,
+    as a (len(rows), len(block)) array
+
+    the cosine numerators are the entries of A*A^T, and the weighted
+    jaccard numerators the same product with min in place of *: both
+    are accumulated for the whole query block at once over every
+    query -> teammate -> candidate step, like two_hop_scores.  candidates
+    that are the query itself or already connected to it get -inf; the
+    rest get exactly the score two_hop_scores gives them (zero beyond
+    two hops)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    num_rows, num_candidates = len(rows), len(block)
+
+    # every (query, teammate) pair, then every (query, teammate, candidate)
+    query_entries, query_lengths = graph.entry_positions(rows)
+    query_of = np.repeat(np.arange(num_rows), query_lengths)
+    teammates = graph.indices[query_entries]
+    query_weights = graph.weights[query_entries]
+
+    entries, lengths = gather_positions(block.teammate_indptr, teammates)
+    cells = (np.repeat(query_of * num_candidates, lengths) +
+             block.teammate_positions[entries])
+    via = np.repeat(query_weights, lengths)
+    weights = block.teammate_weights[entries]
+
+    # integer-valued float sums, exact well past any realistic weight
+    size = num_rows * num_candidates
+    sum_min = np.bincount(cells, weights=np.minimum(via, weights),
+                          minlength=size).reshape(num_rows, num_candidates)
+    dot = np.bincount(cells, weights=via * weights,
+                      minlength=size).reshape(num_rows, num_candidates)
+
+    sum_max = graph.weighted_degrees[rows][:, None] + block.sums - sum_min
+    jaccard = sum_min / np.maximum(1, sum_max)
+    cosine = dot / np.maximum(1, np.outer(np.maximum(1, graph.norms[rows]),
+                                          np.maximum(1, block.norms)))
+    scores = jaccard + cosine
+
+    # not-already-connected mask
+    connected = block.positions[teammates]
+    found = connected >= 0
+    scores[query_of[found], connected[found]] = float('-inf')
+    itself = block.positions[rows]
+    found = itself >= 0
+    scores[np.flatnonzero(found), itself[found]] = float('-inf')
+    return scores
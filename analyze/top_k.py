@@ -0,0 +1,88 @@
+"""
+top-k selection: a bounded heap for streaming input, and
+argpartition for arrays of scores
+
+ties are always broken in favor of whatever was seen first (lowest
+position), so results are reproducible between runs
+"""
+
+import heapq
+import numpy as np
+
+
+class TopK(object):
+    """
+    keep the k highest-scoring items pushed so far, in a min-heap of
+    (score, -position, item) so the weakest entry is always on top
+    """
+    def __init__(self, k):
+        self.k = k
+        self._heap = []
+        self._count = 0
+
+    def push(self, score, item):
+        """ offer one item; it is kept only if it beats the current k-th """
+        entry = (score, -self._count, item)
+        self._count += 1
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif self.k and entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    def items(self):
+        """ return the kept (score, item) pairs, best first """
+        return [(score, item) for score, _, item in
+                sorted(self._heap, key=lambda e: e[:2], reverse=True)]
+
+    def __len__(self):
+        return len(self._heap)
+
+
+def top_k_indices(scores, k):
+    """
+    indices of the k largest entries of the scores array, highest
+    first. argpartition finds the k-th largest value; entries tied with
+    it are taken in index order
+    """
+    scores = np.asarray(scores)
+    n = len(scores)
+    k = min(k, n)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    kth = scores[np.argpartition(scores, n - k)[n - k]]
+    above = np.flatnonzero(scores > kth)
+    ties = np.flatnonzero(scores == kth)[:k - len(above)]
+    chosen = np.concatenate((above, ties))
+
+    # best score first, lower index first among equal scores
+    return chosen[np.lexsort((chosen, -scores[chosen]))]
+
+
+def top_k_rows(scores, k):
+    """
+    top_k_indices for every row of a 2-d scores array at once: a
+    (num_rows, min(k, num_columns)) array of column indices, highest
+    first, ties in column order.  argpartition cuts each row down to
+    its k-th largest value, then only the entries at or above it are
+    ordered
+    """
+    scores = np.asarray(scores)
+    num_rows, n = scores.shape
+    k = min(k, n)
+    if k <= 0:
+        return np.zeros((num_rows, 0), dtype=np.int64)
+
+    kth = np.take_along_axis(scores, np.argpartition(scores, n - k, axis=1)
+                             [:, n - k:n - k + 1], axis=1)
+    contenders = scores >= kth
+
+    # rank contenders (at least k per row) by (row, -score, column)
+    row_ids, columns = np.nonzero(contenders)
+    order = np.lexsort((columns, -scores[row_ids, columns], row_ids))
+    row_ids, columns = row_ids[order], columns[order]
+
+    # the first k of each row's run
+    starts = np.searchsorted(row_ids, np.arange(num_rows))
+    picks = starts[:, None] + np.arange(k)
+    return columns[picks]
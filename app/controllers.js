@@ -2,56 +2,133 @@ angular.module('BudaApp.controllers', [])
 .controller('playerController', function($scope, $http, $q) {
   $scope.nodes = {};
   $scope.playerList = [];
-  
+
   $scope.searchFilter = function (player) {
     var re = new RegExp($scope.nameFilter, 'i');
     return $scope.nameFilter && $scope.nameFilter.length > 4 && re.test(player.id);
   };
-  
+
   // async load
   var baseUrl = '';
-  
-  var loadNodes = $q.defer();
-  var loadResults = $q.defer();
-  var loadEgos = $q.defer();
-  
-  // load all three data files asynchronously
-  $http({url: baseUrl + 'nodes.json'})
-    .success(function (data) {
-      data.forEach(function(node) {
-        $scope.nodes[node.id] = node.label;
+  var exportUrl = baseUrl + 'export/';
+
+  // use the sharded export (jsonify_results.py --sharded) if there is one,
+  // otherwise the whole-dataset files
+  $http({url: exportUrl + 'manifest.json'})
+    .success(loadShards)
+    .error(loadAll);
+
+  function loadAll() {
+    var loadNodes = $q.defer();
+    var loadResults = $q.defer();
+    var loadEgos = $q.defer();
+
+    // load all three data files asynchronously
+    $http({url: baseUrl + 'nodes.json'})
+      .success(function (data) {
+        data.forEach(function(node) {
+          $scope.nodes[node.id] = node.label;
+        });
+        loadNodes.resolve(data);
       });
-      loadNodes.resolve(data);
-    });
-  
-  $http({url: baseUrl + 'similarities.json'})
-    .success(function (data) {
-      $scope.playerList = data;
-      loadResults.resolve(data);
-    });
-  
-  $http({url: baseUrl + 'egos.json'})
-    .success(function (data) {
-      loadEgos.resolve(data);
-    });
-  
-  $q.all([loadNodes.promise, loadResults.promise, loadEgos.promise])
-    .then(function(values) {
-      // make dict of ego values
-      var egoDict = {};
-      values[2].forEach(function(d) {
-        egoDict[d.id] = d.list;
-      })
-          
-      $scope.playerList.forEach(function(player) {
-        // assign ego results
-        player.egos = egoDict[player.id];
-        // replace id with name
-        player.id = $scope.nodes[player.id];
-        // same for player's list
-        player.list.forEach(function(sim) {
-          sim.n = $scope.nodes[sim.n];
+
+    $http({url: baseUrl + 'similarities.json'})
+      .success(function (data) {
+        $scope.playerList = data;
+        loadResults.resolve(data);
+      });
+
+    $http({url: baseUrl + 'egos.json'})
+      .success(function (data) {
+        loadEgos.resolve(data);
+      });
+
+    $q.all([loadNodes.promise, loadResults.promise, loadEgos.promise])
+      .then(function(values) {
+        // make dict of ego values
+        var egoDict = {};
+        values[2].forEach(function(d) {
+          egoDict[d.id] = d.list;
+        })
+
+        $scope.playerList.forEach(function(player) {
+          // assign ego results
+          player.egos = egoDict[player.id];
+          // replace id with name
+          player.id = $scope.nodes[player.id];
+          // same for player's list
+          player.list.forEach(function(sim) {
+            sim.n = $scope.nodes[sim.n];
+          });
         });
       });
+  }
+
+  function loadShards(manifest) {
+    // names/ and shards/ files, each fetched at most once
+    var files = {};
+    function fetch(path) {
+      if (!files[path]) {
+        files[path] = $http({url: exportUrl + path})
+          .then(function (response) { return response.data; });
+      }
+      return files[path];
+    }
+
+    // same file naming as jsonify_results.name_file_prefix
+    function namePrefix(key) {
+      return key.slice(0, 2).replace(/[^a-z0-9]/g, '_') || '_';
+    }
+
+    // look up players as the name is typed: the names file for its first
+    // two letters, then the shard of each matching player
+    $scope.$watch('nameFilter', function (nameFilter) {
+      var key = (nameFilter || '').toLowerCase().split(/\s+/)
+        .filter(function (word) { return word; }).join(' ');
+      if (key.length <= 4 || !manifest.names[namePrefix(key)]) {
+        $scope.playerList = [];
+        return;
+      }
+      fetch('names/' + namePrefix(key) + '.json')
+        .then(function (entries) {
+          // entries are sorted by key: bisect to the first key >= the one
+          // typed, then the matches follow it
+          var lo = 0, hi = entries.length;
+          while (lo < hi) {
+            var mid = (lo + hi) >> 1;
+            if (entries[mid][0] < key) {
+              lo = mid + 1;
+            } else {
+              hi = mid;
+            }
+          }
+          var ids = [];
+          for (var i = lo; i < entries.length &&
+               entries[i][0].indexOf(key) === 0; i++) {
+            if (ids.indexOf(entries[i][1]) < 0) {
+              ids.push(entries[i][1]);
+            }
+          }
+          return $q.all(ids.slice(0, 20).map(function (id) {
+            return fetch('shards/' + Math.floor(id / manifest.shard_size) + '.json')
+              .then(function (shard) { return shard[id]; });
+          }));
+        })
+        .then(function (players) {
+          // ignore answers to a name that has since been typed over
+          if (nameFilter !== $scope.nameFilter) {
+            return;
+          }
+          $scope.playerList = players.filter(function (player) {
+            return player && player.list;
+          }).map(function (player) {
+            return {id: player.label,
+                    list: player.list.map(function (sim) {
+                      return {n: sim.l, s: sim.s};
+                    }),
+                    egos: player.egos};
+          });
+        });
     });
-});
\ No newline at end of file
+  }
+});
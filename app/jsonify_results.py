@@ -1,34 +1,77 @@
 """
 turn results into json format for webapp
+
+jsonify_results writes the three whole-dataset files the app loads.
+export_shards writes the same results split into small files, so a
+lookup fetches a few kilobytes however big the league gets:
+
+    manifest.json       shard size, and the number of players in each
+                        results shard and each name index file
+    shards/<n>.json     players with id // shard_size == n, by id: their
+                        label, similar players (with labels) and egos
+    names/<ab>.json     [key, id, label] entries whose key starts with
+                        ab, sorted by key; each player is listed under
+                        their full name and each later word of it
+
+so a client finds a name by fetching the names file for the first two
+letters typed and bisecting it, then fetches the player's one shard
 """
 
+import os
+import sys
 import json
+import shutil
+import tempfile
+from itertools import groupby
 
-if __name__ == "__main__":
-    # read into dict
+
+def read_similarity_results(file_name):
+    """ dict of player label: list of (similar player label, score) """
     similarity_results = {}
-    with open('../analyze/results/similarity_results.csv') as file_in:
+    with open(file_name) as file_in:
         for line in file_in:
             player, player2, sim = line.strip().split(',')
             if player not in similarity_results:
                 similarity_results[player] = []
             similarity_results[player].append((player2, float(sim)))
+    return similarity_results
+
 
+def read_ego_results(file_name):
+    """ dict of player id (as a string): list of (K, fraction of BUDA) """
     ego_results = {}
-    with open('../analyze/results/ego_results.csv') as file_in:
+    with open(file_name) as file_in:
         for line in file_in:
             pid, K, pct = line.strip().split(',')
             if pid not in ego_results:
                 ego_results[pid] = []
             ego_results[pid].append((K, float(pct)))
+    return ego_results
 
-    # nodes
+
+def read_node_ids(file_name):
+    """ dict of player label: node id """
     nodes = {}
-    with open('../data/player_graph/nodes.csv') as file_in:
+    with open(file_name) as file_in:
         next(file_in)  # skip header row
         for line in file_in:
             player_id, label = line.strip().split(',')
             nodes[label] = int(player_id)
+    return nodes
+
+
+def jsonify_results(similarity_file_name, ego_file_name, node_file_name,
+                    out_dir='.'):
+    """
+    write similarities.json, nodes.json and egos.json to out_dir from
+    the analysis results and node list
+    """
+    # read into dict
+    similarity_results = read_similarity_results(similarity_file_name)
+    ego_results = read_ego_results(ego_file_name)
+
+    # nodes
+    nodes = read_node_ids(node_file_name)
 
     # jsonify
     jsonified_results = []
@@ -46,11 +89,153 @@ if __name__ == "__main__":
         jsonified_ego.append({'id': pid, 'list': j})
 
     # save
-    with open('similarities.json', 'w') as file_out:
+    with open(out_dir + '/similarities.json', 'w') as file_out:
         print(json.dumps(jsonified_results), file=file_out)
 
-    with open('nodes.json', 'w') as file_out:
+    with open(out_dir + '/nodes.json', 'w') as file_out:
         print(json.dumps(jsonified_nodes), file=file_out)
 
-    with open('egos.json', 'w') as file_out:
+    with open(out_dir + '/egos.json', 'w') as file_out:
         print(json.dumps(jsonified_ego), file=file_out)
+
+
+def name_keys(label):
+    """
+    lowercase search keys for a label: the full name and each later
+    word of it, so both 'chris' and 'van' find 'Chris Van'
+    """
+    words = label.lower().split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def name_file_prefix(key, length=2):
+    """ the names/ file a search key goes in: its first letters, made safe """
+    prefix = ''.join(c if c.isalnum() and c.isascii() else '_'
+                     for c in key[:length])
+    return prefix or '_'
+
+
+def csv_groups(file_name):
+    """
+    stream a results csv as (first column, list of remaining columns)
+    groups of consecutive rows, which is how each player's results
+    are written
+    """
+    with open(file_name) as file_in:
+        rows = (line.strip().rsplit(',', 2) for line in file_in)
+        for key, group in groupby(rows, key=lambda row: row[0]):
+            yield key, [row[1:] for row in group]
+
+
+def export_shards(similarity_file_name, ego_file_name, node_file_name,
+                  out_dir='export', shard_size=16, max_buffered=4096):
+    """
+    write the similarity and ego results as id-sharded json files plus
+    a manifest and a prefix-sorted name index (see the top of this
+    file) to out_dir, replacing any earlier export
+
+    each results csv is read once, a player at a time: every player's
+    entries are buffered for their shard, every max_buffered players
+    the buffers are appended to per-shard spool files (opened one at a
+    time, so the number of shards isn't limited by open file handles),
+    and each shard is assembled from its spool at the end.  memory
+    holds one shard at a time rather than every result.  -inf padding
+    rows are left out
+    """
+    labels = {pid: label for label, pid in read_node_ids(node_file_name).items()}
+    ids = {label: pid for pid, label in labels.items()}
+    spool_dir = tempfile.mkdtemp(prefix='shards', dir=os.path.dirname(
+                                 os.path.abspath(out_dir)))
+    buffered = {}
+    num_buffered = 0
+    shards = set()
+    players = set()
+
+    def flush():
+        nonlocal num_buffered
+        for shard, lines in buffered.items():
+            with open(os.path.join(spool_dir, str(shard)), 'a') as spool_file:
+                spool_file.writelines(lines)
+        buffered.clear()
+        num_buffered = 0
+
+    def spool(pid, section, entries):
+        nonlocal num_buffered
+        shard = pid // shard_size
+        buffered.setdefault(shard, []).append(
+            json.dumps([pid, section, entries]) + '\n')
+        shards.add(shard)
+        players.add(pid)
+        num_buffered += 1
+        if num_buffered >= max_buffered:
+            flush()
+
+    try:
+        # one streaming pass over each results file
+        for player, rows in csv_groups(similarity_file_name):
+            spool(ids[player], 'list',
+                  [{'n': ids[player2], 'l': player2, 's': float(sim)}
+                   for player2, sim in rows if float(sim) != float('-inf')])
+        for pid, rows in csv_groups(ego_file_name):
+            spool(int(pid), 'egos', [{'k': int(K), 'p': round(100 * float(pct), 2)}
+                                     for K, pct in rows])
+        flush()
+
+        build_dir = out_dir + '.tmp'
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+        os.makedirs(os.path.join(build_dir, 'shards'))
+        os.makedirs(os.path.join(build_dir, 'names'))
+
+        # assemble each shard from its spool
+        manifest = {'version': 1, 'shard_size': shard_size,
+                    'num_players': len(players), 'shards': {}, 'names': {}}
+        for shard in sorted(shards):
+            shard_players = {}
+            with open(os.path.join(spool_dir, str(shard))) as file_in:
+                for line in file_in:
+                    pid, section, entries = json.loads(line)
+                    player = shard_players.setdefault(
+                        str(pid), {'id': pid, 'label': labels[pid]})
+                    player[section] = entries
+            with open(os.path.join(build_dir, 'shards', str(shard) + '.json'),
+                      'w') as file_out:
+                print(json.dumps(shard_players, separators=(',', ':')),
+                      file=file_out)
+            manifest['shards'][str(shard)] = len(shard_players)
+
+        # name index of every exported player
+        name_files = {}
+        for pid in players:
+            for key in name_keys(labels[pid]):
+                name_files.setdefault(name_file_prefix(key), []).append(
+                    [key, pid, labels[pid]])
+        for prefix, entries in sorted(name_files.items()):
+            entries.sort()
+            with open(os.path.join(build_dir, 'names', prefix + '.json'),
+                      'w') as file_out:
+                print(json.dumps(entries, separators=(',', ':')), file=file_out)
+            manifest['names'][prefix] = len(entries)
+
+        with open(os.path.join(build_dir, 'manifest.json'), 'w') as file_out:
+            print(json.dumps(manifest, separators=(',', ':')), file=file_out)
+    finally:
+        shutil.rmtree(spool_dir)
+
+    # swap the finished export in
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(build_dir, out_dir)
+    return manifest
+
+
+if __name__ == "__main__":
+    if '--sharded' in sys.argv[1:]:
+        export_shards('../analyze/results/similarity_results.csv',
+                      '../analyze/results/ego_results.csv',
+                      '../data/player_graph/nodes.csv', 'export')
+        sys.exit()
+
+    jsonify_results('../analyze/results/similarity_results.csv',
+                    '../analyze/results/ego_results.csv',
+                    '../data/player_graph/nodes.csv')
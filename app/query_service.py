@@ -0,0 +1,242 @@
+"""
+local http query service for the app: keeps the graph loaded and
+answers similarity and ego network queries for any player on demand,
+instead of shipping every precomputed result to every browser
+
+    GET /search?q=chr&limit=10    players whose name (or any later
+                                  word of it) starts with q
+    GET /similar?id=123&k=10      top k players similar to player 123
+    GET /ego?id=123&max_k=6       % of BUDA within K degrees, K=1..max_k
+    GET /stats                    cache hits and misses
+
+players can be given by name instead of id (name=...).  results use
+the same json shapes as similarities.json and egos.json (one entry
+each), and recent results are kept in an LRU cache
+
+    python query_service.py [port]
+"""
+
+import sys
+import json
+import bisect
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+sys.path.append('../analyze')
+from graph_functions import (ensure_graph_snapshot, open_graph_snapshot,
+                             read_candidate_ids, recent_ids_file_name)
+from similar_nodes import find_missing_edges
+from ego_networks import calc_ego_network_sizes
+from jsonify_results import name_keys
+
+node_file_path = '../data/player_graph/nodes.csv'
+edge_file_path = '../data/player_graph/edges.csv'
+candidate_file_path = recent_ids_file_name()
+snapshot_path = '../data/player_graph/snapshot'
+
+# bounds on what a single request may ask for
+MAX_TO_FIND = 100
+MAX_K = 10
+MAX_SEARCH_RESULTS = 50
+
+
+class LRUCache(object):
+    """ a dict of at most max_size entries, dropping the least recently used """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ the value for key (marking it as used), or None """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class NameIndex(object):
+    """
+    sorted lowercase name keys (see jsonify_results.name_keys) for
+    search-as-you-type.  a prefix search is a bisect plus a scan over
+    just the matching keys
+    """
+    def __init__(self, nodes):
+        entries = sorted(set((key, uid) for uid, label in nodes.items()
+                             for key in name_keys(label)))
+        self.keys = [key for key, uid in entries]
+        self.ids = [uid for key, uid in entries]
+
+    def search(self, prefix, limit=10):
+        """ ids of up to limit players matching prefix, in key order """
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix:
+            return []
+        found = []
+        i = bisect.bisect_left(self.keys, prefix)
+        while (i < len(self.keys) and self.keys[i].startswith(prefix) and
+               len(found) < limit):
+            if self.ids[i] not in found:
+                found.append(self.ids[i])
+            i += 1
+        return found
+
+
+class QueryService(object):
+    """
+    the graph, node labels and recommendation candidates, with cached
+    similarity and ego network queries against them
+    """
+    def __init__(self, graph, nodes, candidate_ids, cache_size=4096):
+        self.graph = graph
+        self.nodes = nodes
+        self.candidate_ids = candidate_ids
+        self.ids_by_label = {label.strip(): uid for uid, label in nodes.items()}
+        self.name_index = NameIndex(nodes)
+        self.cache = LRUCache(cache_size)
+        # the scoring functions reuse per-block scratch buffers
+        self.compute_lock = threading.Lock()
+
+    def player_id(self, uid=None, name=None):
+        """ the node id of a player given by id or exact name """
+        if uid is None and name is None:
+            raise ValueError('give a player id or name')
+        if uid is None:
+            uid = self.ids_by_label.get(name.strip())
+            if uid is None:
+                raise KeyError('no player named ' + name)
+        if uid not in self.nodes:
+            raise KeyError('no player with id ' + str(uid))
+        return uid
+
+    def cached(self, key, compute):
+        result = self.cache.get(key)
+        if result is None:
+            with self.compute_lock:
+                result = compute()
+            self.cache.put(key, result)
+        return result
+
+    def similar(self, uid, num_to_find=10):
+        """
+        a similarities.json entry for uid: the top num_to_find players
+        by find_missing_edges, without its -inf padding (an empty list
+        for players who never played)
+        """
+        def compute():
+            result = find_missing_edges(uid, self.candidate_ids, self.graph,
+                                        num_to_find=num_to_find) or []
+            return {'id': uid,
+                    'list': [{'n': uid2, 's': round(sim, 2)}
+                             for (_, uid2, sim) in result
+                             if sim != float('-inf')]}
+        return self.cached(('similar', uid, num_to_find), compute)
+
+    def ego(self, uid, max_k=6):
+        """ an egos.json entry for uid, with K from 1 to max_k """
+        def compute():
+            result = calc_ego_network_sizes(uid, max_k, self.graph)
+            # rounded twice, exactly as ego_networks.py and
+            # jsonify_results.py do
+            num_nodes = len(self.nodes)
+            return {'id': uid,
+                    'list': [{'k': K,
+                              'p': round(100 * round(size / num_nodes, 4), 2)}
+                             for (_, K, size) in result]}
+        return self.cached(('ego', uid, max_k), compute)
+
+    def search(self, prefix, limit=10):
+        """ nodes.json entries of players matching a name prefix """
+        return [{'id': uid, 'label': self.nodes[uid]}
+                for uid in self.name_index.search(prefix, limit)]
+
+
+def int_param(query, name, default=None, low=None, high=None):
+    """ an integer query parameter, checked against [low, high] """
+    if name not in query:
+        return default
+    value = int(query[name][0])
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise ValueError('{0} must be between {1} and {2}'.format(name, low,
+                                                                  high))
+    return value
+
+
+def make_handler(service):
+    """ a request handler class answering queries from service """
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            try:
+                if url.path == '/search':
+                    result = service.search(
+                        query.get('q', [''])[0],
+                        int_param(query, 'limit', 10, 1, MAX_SEARCH_RESULTS))
+                elif url.path == '/stats':
+                    result = service.cache.stats()
+                elif url.path in ('/similar', '/ego'):
+                    uid = service.player_id(int_param(query, 'id'),
+                                            query.get('name', [None])[0])
+                    if url.path == '/similar':
+                        result = service.similar(
+                            uid, int_param(query, 'k', 10, 1, MAX_TO_FIND))
+                    else:
+                        result = service.ego(
+                            uid, int_param(query, 'max_k', 6, 1, MAX_K))
+                else:
+                    raise KeyError('unknown path ' + url.path)
+            except ValueError as err:
+                return self.send_json(400, {'error': str(err)})
+            except KeyError as err:
+                return self.send_json(404, {'error': err.args[0]})
+            self.send_json(200, result)
+
+        def send_json(self, status, result):
+            body = json.dumps(result).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            # the app may be served from elsewhere
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+
+    return QueryHandler
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+
+    ensure_graph_snapshot(node_file_path, edge_file_path, snapshot_path)
+    graph, nodes = open_graph_snapshot(snapshot_path)
+    service = QueryService(graph, nodes, read_candidate_ids(candidate_file_path))
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(service))
+    print('serving on http://127.0.0.1:{0}/'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,367 @@
+"""
+time every stage of the pipeline on synthetic rosters of a few sizes
+
+each stage runs in a fresh process (so its peak RSS is its own) on
+the files the earlier stages wrote, and reports wall time, throughput
+and peak RSS, plus the size of the graph arrays the analyses load
+(smaller with BUDA_COMPACT_GRAPH set).  results are saved as json in
+results/, and compared against results/baseline.json if there is one
+
+    python benchmark.py                 all scales
+    python benchmark.py small buda      just these
+    python benchmark.py --baseline      also save as the new baseline
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import traceback
+from multiprocessing import get_context
+import numpy as np
+
+sys.path.append('../create')
+sys.path.append('../analyze')
+sys.path.append('../app')
+from synthetic_roster import generate_roster
+
+# roster sizes to benchmark; buda is about the size of the real roster
+SCALES = {
+    'small': dict(num_players=3000, teams_per_season=60, roster_size=14,
+                  num_seasons=8),
+    'buda': dict(num_players=12000, teams_per_season=240, roster_size=14,
+                 num_seasons=16),
+    'large': dict(num_players=48000, teams_per_season=960, roster_size=14,
+                  num_seasons=16),
+}
+
+# queries timed one at a time, and in the batched pipeline
+SINGLE_QUERIES = 200
+BLOCK_QUERIES = 2000
+EGO_SINGLE_QUERIES = 50
+EGO_BATCH_QUERIES = 512
+
+# ratio to the baseline time flagged as a regression
+REGRESSION_RATIO = 1.25
+
+
+def peak_rss_mb():
+    """ peak resident set size of this process so far, in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(function, *args, **kwargs):
+    """ call function, returning its result and the seconds it took """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def count_lines(file_name, header=True):
+    """ number of lines in file_name, not counting a header row """
+    with open(file_name) as file_in:
+        return sum(1 for line in file_in) - int(header)
+
+
+def work_file(work_dir, name):
+    return os.path.join(work_dir, name)
+
+
+def load_graph_inputs(work_dir):
+    """
+    the CSR graph (compact with BUDA_COMPACT_GRAPH set), node labels and
+    candidate ids written so far
+    """
+    from graph_functions import (load_csr_graph, read_candidate_ids,
+                                 use_compact_graph)
+    graph, nodes = load_csr_graph(work_file(work_dir, 'nodes.csv'),
+                                  work_file(work_dir, 'edges.csv'),
+                                  compact=use_compact_graph())
+    candidates = read_candidate_ids(work_file(work_dir, 'node_ids.txt'))
+    return graph, nodes, candidates
+
+
+# each stage reads its inputs, times its work, writes its outputs and
+# returns (seconds, number of items processed, item name)
+
+def stage_read_roster(work_dir):
+    from parse_tools import read_roster
+    roster, seconds = timed(read_roster, work_file(work_dir, 'roster_data.tsv'))
+    return seconds, len(roster), 'lines'
+
+
+def stage_extract_nodes(work_dir):
+    from parse_tools import read_roster
+    from player_graph_init import extract_nodes
+    roster = read_roster(work_file(work_dir, 'roster_data.tsv'))
+    nodes, seconds = timed(extract_nodes, roster,
+                           work_file(work_dir, 'nodes.csv'))
+    return seconds, len(nodes), 'nodes'
+
+
+def stage_extract_edges(work_dir):
+    from parse_tools import read_roster
+    from player_graph_init import extract_edges
+    roster = read_roster(work_file(work_dir, 'roster_data.tsv'))
+    nodes = {player: uid for uid, player in enumerate(roster.names, 1)}
+    _, seconds = timed(extract_edges, roster, work_file(work_dir, 'edges.csv'),
+                       nodes)
+    return seconds, count_lines(work_file(work_dir, 'edges.csv')), 'edges'
+
+
+def stage_combine_raw_edges(work_dir):
+    from parse_tools import read_roster
+    from player_graph_init import process_team
+    from combine_raw_edges import combine_raw_edges
+
+    # one raw edge per pair per team, as older versions of
+    # player_graph_init wrote them
+    roster = read_roster(work_file(work_dir, 'roster_data.tsv'))
+    raw_file_name = work_file(work_dir, 'raw_edges.csv')
+    node_ids = np.arange(1, len(roster.names) + 1)
+    with open(raw_file_name, 'w') as file_out:
+        print('source,target,label', file=file_out)
+        for start, stop in roster.team_bounds():
+            sources, targets = process_team(node_ids[roster.name_ids[start:stop]])
+            for src, tgt in zip(sources.tolist(), targets.tolist()):
+                print(src, tgt, roster.names[src - 1] + " - " +
+                      roster.names[tgt - 1], sep=',', file=file_out)
+
+    _, seconds = timed(combine_raw_edges, raw_file_name,
+                       work_file(work_dir, 'combined_edges.csv'))
+    return seconds, count_lines(raw_file_name), 'raw edges'
+
+
+def stage_load_adjacency_matrix(work_dir):
+    from graph_functions import load_adjacency_matrix
+    (graph, nodes), seconds = timed(load_adjacency_matrix,
+                                    work_file(work_dir, 'nodes.csv'),
+                                    work_file(work_dir, 'edges.csv'),
+                                    sparse=True)
+    return seconds, graph.num_edges, 'edges'
+
+
+def stage_find_recent_ids(work_dir):
+    from parse_tools import read_roster
+    from temporal_graph import last_seasons_played
+    from find_recent_players import find_recent_ids
+
+    # players in the last two seasons are the ones to recommend for
+    roster = read_roster(work_file(work_dir, 'roster_data.tsv'))
+    node_ids = np.arange(1, len(roster.names) + 1)
+    start = time.perf_counter()
+    last_seasons = last_seasons_played(roster, node_ids, len(node_ids))
+    recent_ids = find_recent_ids(last_seasons, roster.seasons.max() - 1)
+    seconds = time.perf_counter() - start
+
+    with open(work_file(work_dir, 'node_ids.txt'), 'w') as file_out:
+        for rid in recent_ids:
+            print(rid, file=file_out)
+    return seconds, len(recent_ids), 'recent players'
+
+
+def stage_find_missing_edges(work_dir):
+    from similar_nodes import find_missing_edges
+    graph, nodes, candidates = load_graph_inputs(work_dir)
+    find_missing_edges(candidates[0], candidates, graph)  # build the block
+    queries = candidates[:SINGLE_QUERIES]
+    start = time.perf_counter()
+    for uid in queries:
+        find_missing_edges(uid, candidates, graph)
+    return time.perf_counter() - start, len(queries), 'queries'
+
+
+def stage_find_missing_edges_block(work_dir):
+    import similar_nodes
+    from similarity_kernel import get_candidate_block, plan_query_blocks
+    graph, nodes, candidates = load_graph_inputs(work_dir)
+    queries = candidates[:BLOCK_QUERIES]
+
+    start = time.perf_counter()
+    block = get_candidate_block(graph, candidates)
+    results = []
+    for batch in plan_query_blocks(graph, [x - 1 for x in queries], block):
+        results += similar_nodes.find_missing_edges_block(
+            [row + 1 for row in batch], candidates, graph)
+    seconds = time.perf_counter() - start
+
+    similar_nodes.nodes = nodes
+    with open(work_file(work_dir, 'similarity_results.csv'), 'w') as file_out:
+        for result in results:
+            if result:
+                file_out.writelines(
+                    similar_nodes.format_similarity_result(result)[1])
+    return seconds, len(queries), 'queries'
+
+
+def stage_calc_ego_network_sizes(work_dir):
+    from ego_networks import calc_ego_network_sizes
+    graph, nodes, candidates = load_graph_inputs(work_dir)
+    queries = candidates[:EGO_SINGLE_QUERIES]
+    start = time.perf_counter()
+    for uid in queries:
+        calc_ego_network_sizes(uid, adj_mat=graph)
+    return time.perf_counter() - start, len(queries), 'queries'
+
+
+def stage_calc_ego_network_sizes_batch(work_dir):
+    from ego_networks import calc_ego_network_sizes_batch, write_ego_results
+    graph, nodes, candidates = load_graph_inputs(work_dir)
+    queries = candidates[:EGO_BATCH_QUERIES]
+
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(queries), 64):
+        results += calc_ego_network_sizes_batch(queries[i:i + 64],
+                                                adj_mat=graph)
+    seconds = time.perf_counter() - start
+
+    with open(work_file(work_dir, 'ego_results.csv'), 'w') as file_out, \
+         open(os.devnull, 'w') as processed:
+        write_ego_results(results, len(nodes), file_out, processed)
+    return seconds, len(queries), 'queries'
+
+
+def stage_network_statistics(work_dir):
+    from network_statistics import network_stats
+    graph, nodes, candidates = load_graph_inputs(work_dir)
+    _, seconds = timed(network_stats, graph)
+    return seconds, graph.num_edges, 'edges'
+
+
+def stage_jsonify_results(work_dir):
+    from jsonify_results import jsonify_results
+    _, seconds = timed(jsonify_results,
+                       work_file(work_dir, 'similarity_results.csv'),
+                       work_file(work_dir, 'ego_results.csv'),
+                       work_file(work_dir, 'nodes.csv'), work_dir)
+    return (seconds, count_lines(work_file(work_dir, 'similarity_results.csv'),
+                                 header=False), 'result rows')
+
+
+# in pipeline order: each stage may read what the earlier ones wrote
+STAGES = [
+    ('read_roster', stage_read_roster),
+    ('extract_nodes', stage_extract_nodes),
+    ('extract_edges', stage_extract_edges),
+    ('combine_raw_edges', stage_combine_raw_edges),
+    ('load_adjacency_matrix', stage_load_adjacency_matrix),
+    ('find_recent_ids', stage_find_recent_ids),
+    ('find_missing_edges', stage_find_missing_edges),
+    ('find_missing_edges_block', stage_find_missing_edges_block),
+    ('calc_ego_network_sizes', stage_calc_ego_network_sizes),
+    ('calc_ego_network_sizes_batch', stage_calc_ego_network_sizes_batch),
+    ('network_statistics', stage_network_statistics),
+    ('jsonify_results', stage_jsonify_results),
+]
+
+
+def run_stage(stage, work_dir, conn):
+    """
+    process target: run one stage and send back its measurements, or
+    the traceback if it raised
+    """
+    try:
+        seconds, items, unit = dict(STAGES)[stage](work_dir)
+    except Exception:
+        conn.send({'error': traceback.format_exc()})
+        conn.close()
+        return
+    conn.send({'seconds': seconds,
+               'items': int(items),
+               'unit': unit,
+               'throughput': items / seconds if seconds > 0 else None,
+               'peak_rss_mb': peak_rss_mb()})
+    conn.close()
+
+
+def run_scale(scale, params):
+    """ generate a roster at one scale and time every stage on it """
+    context = get_context('spawn')
+    report = {'params': params, 'stages': {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        lines, seconds = timed(generate_roster,
+                               work_file(work_dir, 'roster_data.tsv'), **params)
+        report['roster_lines'] = lines
+        print('{0}: {1} roster lines ({2:.1f}s to generate)'.format(
+              scale, lines, seconds), flush=True)
+
+        for stage, _ in STAGES:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_stage,
+                                      args=(stage, work_dir, sender))
+            process.start()
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None
+            process.join()
+            if result is None:
+                # died without sending anything (killed, out of memory, ...)
+                result = {'error': 'exited with code {0}'.format(
+                          process.exitcode)}
+            if 'error' in result:
+                # later stages read this one's files, so stop here
+                raise RuntimeError('stage {0} failed at scale {1}:\n{2}'.format(
+                                   stage, scale, result['error']))
+            report['stages'][stage] = result
+            print('  {0:<30} {1:9.3f}s {2:12.1f} {3}/s {4:8.1f} MB'.format(
+                  stage, result['seconds'], result['throughput'] or 0,
+                  result['unit'], result['peak_rss_mb']), flush=True)
+
+        # what the analyses hold the graph in, compact or not
+        from graph_functions import graph_nbytes
+        graph, _, _ = load_graph_inputs(work_dir)
+        report['graph_mb'] = graph_nbytes(graph) / 2 ** 20
+        print('  {0:<30} {1:8.1f} MB'.format('graph arrays',
+                                             report['graph_mb']), flush=True)
+    return report
+
+
+def compare_to_baseline(reports, baseline):
+    """ print each stage's time relative to the baseline's """
+    print('\nrelative to baseline (time ratio):')
+    for scale, report in reports.items():
+        if scale not in baseline['scales']:
+            continue
+        base_stages = baseline['scales'][scale]['stages']
+        for stage, result in report['stages'].items():
+            if stage not in base_stages or not base_stages[stage]['seconds']:
+                continue
+            ratio = result['seconds'] / base_stages[stage]['seconds']
+            flag = '  REGRESSION' if ratio > REGRESSION_RATIO else ''
+            print('  {0:<6} {1:<30} {2:6.2f}x{3}'.format(scale, stage, ratio,
+                                                         flag))
+
+
+if __name__ == "__main__":
+    save_baseline = '--baseline' in sys.argv[1:]
+    scales = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    scales = scales or list(SCALES)
+
+    reports = {scale: run_scale(scale, SCALES[scale]) for scale in scales}
+    output = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0],
+              'numpy': np.__version__,
+              'cpu_count': os.cpu_count(),
+              'compact_graph': os.environ.get('BUDA_COMPACT_GRAPH', ''),
+              'scales': reports}
+
+    os.makedirs('results', exist_ok=True)
+    output_file_name = 'results/benchmark_{0}.json'.format(
+        time.strftime('%Y%m%d_%H%M%S'))
+    with open(output_file_name, 'w') as file_out:
+        print(json.dumps(output, indent=1), file=file_out)
+    print('\nsaved', output_file_name)
+
+    baseline_file_name = 'results/baseline.json'
+    if os.path.exists(baseline_file_name):
+        with open(baseline_file_name) as file_in:
+            compare_to_baseline(reports, json.loads(file_in.read()))
+    if save_baseline or not os.path.exists(baseline_file_name):
+        with open(baseline_file_name, 'w') as file_out:
+            print(json.dumps(output, indent=1), file=file_out)
+        print('saved', baseline_file_name)
@@ -0,0 +1,63 @@
+"""
+generate a synthetic roster file, in the format scrape.py writes
+(player, team id, league id, season, tab separated), for benchmarks
+
+players have careers of a few seasons and some play far more than
+others, so degrees and edge weights are skewed like the real league's
+"""
+
+import numpy as np
+
+
+def player_name(i):
+    """ a unique 'Last, First' name for player i """
+    return 'Player{0:06d}, Synthetic'.format(i)
+
+
+def generate_roster(file_name, num_players=12000, teams_per_season=240,
+                    roster_size=14, num_seasons=16, teams_per_league=10,
+                    first_season=1999, seed=0):
+    """
+    write a roster of num_seasons seasons, each with teams_per_season
+    teams of roster_size players grouped into leagues of
+    teams_per_league teams, drawn from num_players players
+
+    returns the number of roster lines written
+    """
+    rng = np.random.default_rng(seed)
+
+    # careers: a start season and a length, and how keen each player is
+    starts = rng.integers(-4, num_seasons, num_players)
+    lengths = rng.geometric(0.3, num_players)
+    keenness = rng.pareto(2.0, num_players) + 1
+
+    num_lines = 0
+    team_id = 1000
+    league_id = 1000
+    with open(file_name, 'w') as file_out:
+        for season in range(num_seasons):
+            active = np.flatnonzero((starts <= season) &
+                                    (season < starts + lengths))
+            if len(active) < roster_size:
+                active = np.arange(num_players)
+            weights = keenness[active] / keenness[active].sum()
+
+            for team in range(teams_per_season):
+                if team % teams_per_league == 0:
+                    league_id += 1
+                team_id += 1
+                players = rng.choice(active, min(roster_size, len(active)),
+                                     replace=False, p=weights)
+                # rosters are listed alphabetically, like the real ones
+                for i in np.sort(players).tolist():
+                    print(player_name(i), team_id, league_id,
+                          first_season + season, sep='\t', file=file_out)
+                    num_lines += 1
+    return num_lines
+
+
+if __name__ == "__main__":
+    import os
+    os.makedirs('../data/synthetic', exist_ok=True)
+    num_lines = generate_roster('../data/synthetic/roster_data.tsv')
+    print(num_lines, 'roster lines')
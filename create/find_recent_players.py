@@ -2,48 +2,43 @@
 find node ids of players that have recently played
 """
 
-from parse_tools import parse_line, format_name
+import os
+import sys
+import numpy as np
+sys.path.append('../analyze')
+from parse_tools import read_roster
 
-def find_recent_ids(nodes, year_thresh, roster_file_name):
+def find_recent_ids(last_seasons, year_thresh):
     """
-    loop through roster file and check players
-    against thresh. return ids of new players from nodes
+    query the temporal index (the last season each player played,
+    indexed by node id - 1) against thresh. return ids of the players
+    seen since, in id order
     """
-    recent_players = set()
-
-    with open(roster_file_name) as file_in:
-        for line in file_in:
-            player, _, _, year = parse_line(line)
-
-            if int(year) >= year_thresh:
-                recent_players.add(format_name(player))
-
-    recent_ids = []
-    for node_id, name in nodes.items():
-        if name in recent_players:
-            recent_ids.append(node_id)
-    return recent_ids
+    return (np.flatnonzero(last_seasons >= year_thresh) + 1).tolist()
 
 if __name__ == "__main__":
     node_file_name = '../data/player_graph/nodes.csv'
     roster_file_name = '../data/roster_data.tsv'
-
-    year_thresh = 2013
-
-    output_file_name = '../data/player_graph/node_ids_since_'
-    output_file_name += str(year_thresh)
-    output_file_name += '.txt'
-
-    # read nodes
-    nodes = {}
-    with open(node_file_name, 'r') as file_in:
-        next(file_in)  # skip header row
-        for line in file_in:
-            player_id, label = line.strip().split(',')
-            nodes[int(player_id)] = label
-
-    recent_ids = find_recent_ids(nodes, int(year_thresh),
-                                 roster_file_name)
+    season_dir = '../data/player_graph/seasons'
+
+    from temporal_graph import build_season_store, read_season_index
+    from graph_functions import default_year_thresh, recent_ids_file_name
+
+    year_thresh = default_year_thresh()
+    output_file_name = recent_ids_file_name(year_thresh)
+
+    # the roster is only read if the season history is missing
+    if not os.path.exists(os.path.join(season_dir, 'meta.json')):
+        nodes = {}
+        with open(node_file_name, 'r') as file_in:
+            next(file_in)  # skip header row
+            for line in file_in:
+                player_id, label = line.strip().split(',')
+                nodes[int(player_id)] = label
+        build_season_store(read_roster(roster_file_name), nodes, season_dir)
+
+    seasons, last_seasons = read_season_index(season_dir)
+    recent_ids = find_recent_ids(last_seasons, int(year_thresh))
 
     with open(output_file_name, 'w') as file_out:
         for rid in recent_ids:
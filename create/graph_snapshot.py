@@ -0,0 +1,16 @@
+"""
+compile the node and weighted edge lists into a binary,
+memory-mappable snapshot of the player graph for the analyses
+"""
+
+import sys
+sys.path.append('../analyze')
+from graph_functions import load_csr_graph, save_graph_snapshot
+
+if __name__ == '__main__':
+    node_file_name = '../data/player_graph/nodes.csv'
+    edge_file_name = '../data/player_graph/edges.csv'
+    snapshot_dir = '../data/player_graph/snapshot'
+
+    graph, nodes = load_csr_graph(node_file_name, edge_file_name)
+    save_graph_snapshot(graph, nodes, snapshot_dir)
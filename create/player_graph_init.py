@@ -1,39 +1,67 @@
 """
 from player_data.tsv, get the list
-of distinct player names
+of distinct player names, and the weighted
+edges between players who shared a team
 """
 
-from parse_tools import parse_line, format_name
+import sys
+import numpy as np
+sys.path.append('../analyze')
+from parse_tools import read_roster
+from instrument import timed, count, stage, write_summary
 
-def process_team(this_team, nodes, file_obj_out):
+@timed('process_team')
+def process_team(team_ids):
     """
-    write all of the combinations of players in
-    <this_team> as graph edges to <file_obj_out>,
-    using the player_ids in <nodes>
+    return arrays of source ids and target ids for every
+    combination of players in a roster, given the roster's
+    player ids (as a numpy array) in roster order
     """
-    for i, player_one in enumerate(this_team):
-        for j, player_two in enumerate(this_team):
-            if j > i and nodes[player_one] != nodes[player_two]:
-                # write the source id and target id to file
-                print(nodes[player_one], nodes[player_two],
-                      player_one + " - " + player_two,
-                      sep=',', file=file_obj_out)
+    first, second = np.triu_indices(len(team_ids), 1)
+    sources, targets = team_ids[first], team_ids[second]
+    distinct = sources != targets  # same name listed twice
+    return sources[distinct], targets[distinct]
 
 
-def extract_nodes(file_name, file_name_out):
+def combine_edges(sources, targets):
+    """
+    count how many times each (source, target) pair occurs,
+    returning the distinct pairs in order of first occurrence
+    along with their counts as weights
+    """
+    keys = sources * (max(targets.max(initial=0), 0) + 1) + targets
+    _, first, counts = np.unique(keys, return_index=True,
+                                 return_counts=True)
+    order = np.argsort(first)
+    return sources[first[order]], targets[first[order]], counts[order]
+
+
+def season_edges(roster, node_ids):
+    """
+    per-season weighted edges from a parse_tools.Roster, given the node
+    id of each of its names: a dict of season to (sources, targets,
+    weights), each pair counted once with the smaller id as source
+    """
+    seasons = {}
+    for start, stop in roster.team_bounds():
+        sources, targets = process_team(node_ids[roster.name_ids[start:stop]])
+        season = seasons.setdefault(int(roster.seasons[start]), ([], []))
+        season[0].append(np.minimum(sources, targets))
+        season[1].append(np.maximum(sources, targets))
+
+    return {season: combine_edges(np.concatenate(sources),
+                                  np.concatenate(targets))
+            for season, (sources, targets) in sorted(seasons.items())}
+
+
+def extract_nodes(roster, file_name_out):
     """
     get a dictionary of player names mapped to
-    unique ids
+    unique ids, from a parse_tools.Roster
     """
-    with open(file_name, 'r') as file_in:
-        nodes = {}  # dict of player and unique id
-        uid = 1
-        for line in file_in:
-            fields = parse_line(line)
-            player = format_name(fields[0])
-            if player not in nodes:
-                nodes[player] = uid
-                uid += 1
+    # ids are given out in order of first appearance, which is
+    # exactly the order of the roster's interned names
+    nodes = {player: uid for uid, player in enumerate(roster.names, 1)}
 
     with open(file_name_out, 'w') as file_out:
         print('id,label', file=file_out)
@@ -43,48 +71,65 @@ def extract_nodes(file_name, file_name_out):
     return nodes
 
 
-def extract_edges(file_name, file_name_out, nodes):
+def extract_edges(roster, file_name_out, nodes):
     """
-    with a node list, extract edges of the form
-    source_id, target_id
+    with a node list, extract weighted edges of the form
+    source_id, target_id, label, weight, type
+    from a parse_tools.Roster
+
+    each team's pairs are generated in bulk and the weights are
+    counted in memory, so no intermediate raw edge file is needed
     """
-    with open(file_name, 'r') as file_in, open(file_name_out, 'w') as file_out:
-        print('source,target,label', file=file_out)
-
-        # init the previous entry for comparison
-        last_player, last_team, last_league, last_season = (None, None,
-                                                            None, None)
-        this_team = []
-        for line in file_in:
-            player, team, league, season = parse_line(line)
-            player = format_name(player)
-            if last_player is None or (team == last_team and
-                league == last_league and season == last_season):
-                this_team.append(player)
-            else:  # new player
-                # process existing team
-                process_team(this_team, nodes, file_out)
-
-                # reset and add first player of new team
-                this_team = []
-                this_team.append(player)
-
-            last_player, last_team, last_league, last_season = (player,
-                team, league, season)
-
-        # there is one last team to process
-        process_team(this_team, nodes, file_out)
+    # map the roster's name ids onto node ids
+    node_ids = np.array([nodes[player] for player in roster.names],
+                        dtype=np.int64)
+
+    team_sources = [np.zeros(0, dtype=np.int64)]
+    team_targets = [np.zeros(0, dtype=np.int64)]
+    for start, stop in roster.team_bounds():
+        sources, targets = process_team(node_ids[roster.name_ids[start:stop]])
+        team_sources.append(sources)
+        team_targets.append(targets)
+        count('teams')
+        count('team_pairs', len(sources))
+
+    sources, targets, weights = combine_edges(np.concatenate(team_sources),
+                                              np.concatenate(team_targets))
+
+    labels = {uid: player for player, uid in nodes.items()}
+    with open(file_name_out, 'w') as file_out:
+        print('source,target,label,weight,type', file=file_out)
+        for src, tgt, wgt in zip(sources.tolist(), targets.tolist(),
+                                 weights.tolist()):
+            label = (labels[src] + " - " + labels[tgt]).rstrip()
+            print(src, tgt, label, wgt, 'undirected', sep=',', file=file_out)
 
 
 if __name__ == '__main__':
     # get nodes, then edges for player-centric graph
     file_name_in = '../data/roster_data.tsv'
     node_file_out = '../data/player_graph/nodes.csv'
-    edge_file_out = '../data/player_graph/raw_edges.csv'
-
-    nodes = extract_nodes(file_name_in, node_file_out)
-    extract_edges(file_name_in, edge_file_out, nodes)
-
-
-
-
+    edge_file_out = '../data/player_graph/edges.csv'
+
+    season_dir = '../data/player_graph/seasons'
+
+    # one pass over the roster file feeds both
+    with stage('read_roster') as info:
+        roster = read_roster(file_name_in)
+        info['items'] = len(roster)
+    with stage('extract_nodes') as info:
+        nodes = extract_nodes(roster, node_file_out)
+        info['items'] = len(nodes)
+    with stage('extract_edges') as info:
+        extract_edges(roster, edge_file_out, nodes)
+        info['items'] = len(roster)
+
+    # start the per-season history over to match the new graph
+    from temporal_graph import build_season_store
+    with stage('build_season_store'):
+        build_season_store(roster,
+                           {uid: player for player, uid in nodes.items()},
+                           season_dir)
+
+    # with BUDA_PROFILE set, where the time went (see instrument.py)
+    write_summary()
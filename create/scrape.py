@@ -1,11 +1,26 @@
 """
 get roster info from BUDA.org
+
+pages are fetched concurrently (a few at a time, with a minimum gap
+between requests) and every page is kept in an on-disk cache keyed by
+team, league and season.  a run that stops part way resumes from the
+cache, and a refresh only re-downloads pages the server says changed
 """
 
-import requests
+import os
 import re
+import json
+import asyncio
+import requests
 from bs4 import BeautifulSoup
-from time import sleep
+from time import monotonic
+from urllib.parse import urlsplit, parse_qsl
+
+BASE_URL = "http://buda.org"
+
+# query parameter numbering the later pages of a long roster
+PAGE_PARAMETER = 'page'
+
 
 def parse_file_links(file_name):
     """
@@ -47,37 +62,254 @@ def parse_file_links(file_name):
     return data
 
 
-def scrape_buda(data, file_name_out):
+def roster_page_link(link, page):
+    """ link to page number <page> of the roster at link """
+    if page == 1:
+        return link
+    return link + '&' + PAGE_PARAMETER + '=' + str(page)
+
+
+def roster_page_number(href, link):
     """
-    data is the dict of links, teams, leagues, seasons
-    TODO HANDLE THE TEAMS THAT MIGHT DIVIDE ROSTERS OVER TWO PAGES
+    the page number href links to, if it is a page of the roster at
+    link: the same path and query plus a page parameter, and nothing
+    else (so sort, filter or print links to the page don't count).
+    None otherwise
     """
+    href = urlsplit(href.replace('&amp;', '&'))
+    link = urlsplit(link)
+    params = dict(parse_qsl(href.query))
+    page = params.pop(PAGE_PARAMETER, None)
+    if (href.path != link.path or params != dict(parse_qsl(link.query)) or
+            page is None or not page.isdigit() or int(page) < 1):
+        return None
+    return int(page)
 
-    # get the player names, and put them in a .tsv file with team/league info
-    with open(file_name_out, 'w') as file_out:
-        base_url = "http://buda.org"
+
+def parse_roster_page(text, link):
+    """
+    return the player names on a roster page, and the sorted numbers of
+    the pages of the same roster it links to
+    """
+    soup = BeautifulSoup(text)
+    players = []
+    for item in soup.findAll('td', 'infobody'):
+        player = item.get_text().strip()
+        if player:
+            players.append(player)
+
+    pages = set()
+    for anchor in soup.findAll('a', href=True):
+        page = roster_page_number(anchor['href'], link)
+        if page is not None:
+            pages.add(page)
+    return players, sorted(pages)
+
+
+class RosterCache(object):
+    """
+    fetched roster pages on disk, one html file per page with a json
+    file alongside holding the url and the ETag / Last-Modified headers
+    used for conditional re-fetching.  pages are keyed by
+    season/league/team, plus the page number for later pages
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, team, league, season, page=1):
+        """ file name (without extension) of one cached page """
+        name = league + '-' + team
+        if page > 1:
+            name += '-' + str(page)
+        return os.path.join(self.cache_dir, season, name)
+
+    def get(self, key):
+        """ return (text, meta) for a cached page, or None """
+        path = self.path(*key)
+        if not os.path.exists(path + '.json'):
+            return None
+        with open(path + '.html', encoding='utf-8') as file_in:
+            text = file_in.read()
+        with open(path + '.json') as file_in:
+            meta = json.loads(file_in.read())
+        return text, meta
+
+    def put(self, key, text, meta):
+        """
+        store a page.  both files are written to .tmp files and renamed
+        into place, the json file last, so a page only counts as cached
+        once it is complete and a crash never leaves a truncated one
+        """
+        path = self.path(*key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.html.tmp', 'w', encoding='utf-8') as file_out:
+            file_out.write(text)
+        os.replace(path + '.html.tmp', path + '.html')
+        with open(path + '.json.tmp', 'w') as file_out:
+            print(json.dumps(meta), file=file_out)
+        os.replace(path + '.json.tmp', path + '.json')
+
+
+class PoliteLimiter(object):
+    """
+    async context manager allowing at most max_concurrent requests in
+    flight, with request starts at least min_interval seconds apart
+    """
+    def __init__(self, max_concurrent=4, min_interval=1.0):
+        self.min_interval = min_interval
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._lock = asyncio.Lock()
+        self._last_start = None
+
+    async def __aenter__(self):
+        await self._slots.acquire()
+        async with self._lock:
+            if self._last_start is not None:
+                wait = self._last_start + self.min_interval - monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self._last_start = monotonic()
+
+    async def __aexit__(self, *exc_info):
+        self._slots.release()
+
+
+async def fetch_page(session, limiter, url, meta=None, retries=3):
+    """
+    GET url, conditionally if meta (from the cache) has validators.
+    requests is blocking, so each request runs in a worker thread
+
+    returns (status code, text, meta), or None if every attempt failed
+    """
+    headers = {}
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    for attempt in range(retries):
+        try:
+            async with limiter:
+                r = await asyncio.to_thread(session.get, url,
+                                            headers=headers, timeout=60)
+        except requests.RequestException as e:
+            print(url, e, flush=True)
+            await asyncio.sleep(2 ** attempt)
+            continue
+        if r.status_code >= 500:
+            await asyncio.sleep(2 ** attempt)
+            continue
+        return r.status_code, r.text, {'url': url,
+                                       'etag': r.headers.get('ETag'),
+                                       'last_modified':
+                                           r.headers.get('Last-Modified')}
+    return None
+
+
+async def scrape_team(session, limiter, cache, base_url, link, key,
+                      refresh=False):
+    """
+    return the player names on every page of one team's roster, or
+    None if a page couldn't be fetched
+
+    cached pages are used as is, unless refresh, in which case they are
+    re-fetched conditionally and only replaced if the server sends a
+    new version (the cached page is kept if the re-fetch fails)
+    """
+    players = []
+    pages = [1]
+    for page in pages:
+        page_link = roster_page_link(link, page)
+        page_key = key + (page,)
+        cached = cache.get(page_key)
+        if cached and not refresh:
+            text = cached[0]
+        else:
+            fetched = await fetch_page(session, limiter, base_url + page_link,
+                                       cached[1] if cached else None)
+            status, text, meta = fetched or (None, None, None)
+            if status == 200:
+                print(page_link, flush=True)
+                cache.put(page_key, text, meta)
+            elif cached:
+                # not modified, or the check failed: keep the cached page
+                # rather than drop the team from the roster
+                if status != 304:
+                    print(page_link, 'could not be checked, using cache',
+                          flush=True)
+                text = cached[0]
+            else:
+                return None
+
+        page_players, linked_pages = parse_roster_page(text, link)
+        players += page_players
+        pages += [p for p in linked_pages if p not in pages]
+    return players
+
+
+async def scrape_all(data, cache, base_url=BASE_URL, max_concurrent=4,
+                     min_interval=1.0, refresh_since=None):
+    """
+    scrape every team in data concurrently.  if refresh_since is a
+    season, cached teams from that season on are re-fetched
+    conditionally (older seasons' rosters don't change)
+
+    returns a list of each team's players, None for failed teams
+    """
+    limiter = PoliteLimiter(max_concurrent, min_interval)
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_concurrent)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        tasks = []
         for i, link in enumerate(data['links']):
-            # pause between requests, because I am a gentleman
-            sleep(4)
+            key = (data['teams'][i], data['leagues'][i], data['seasons'][i])
+            refresh = (refresh_since is not None and
+                       int(data['seasons'][i]) >= int(refresh_since))
+            tasks.append(scrape_team(session, limiter, cache, base_url, link,
+                                     key, refresh))
+        return await asyncio.gather(*tasks)
+
+
+def scrape_buda(data, file_name_out, cache_dir, base_url=BASE_URL,
+                max_concurrent=4, min_interval=1.0, refresh_since=None):
+    """
+    data is the dict of links, teams, leagues, seasons
 
-            # get and parse the team info
-            print(link, flush=True)
-            r = requests.get(base_url + link)
-            if r.status_code != 200:
+    the roster file is written from the cache once every team is in,
+    in link order, so an interrupted run leaves the old file alone and
+    the next run picks up where it stopped.  teams that fail are
+    reported and left out; running again retries just those
+    """
+    cache = RosterCache(cache_dir)
+    rosters = asyncio.run(scrape_all(data, cache, base_url, max_concurrent,
+                                     min_interval, refresh_since))
+
+    # get the player names, and put them in a .tsv file with team/league info
+    failed = 0
+    with open(file_name_out + '.tmp', 'w') as file_out:
+        for i, players in enumerate(rosters):
+            if players is None:
+                failed += 1
                 continue
+            for player in players:
+                print(player, data['teams'][i], data['leagues'][i],
+                      data['seasons'][i], sep='\t', file=file_out)
+    os.replace(file_name_out + '.tmp', file_name_out)
 
-            soup = BeautifulSoup(r.text)
-            for item in soup.findAll('td', 'infobody'):
-                player = item.get_text().strip()
-                if player:
-                    print(player, data['teams'][i], data['leagues'][i],
-                          data['seasons'][i], sep='\t', file=file_out)
+    if failed:
+        print(failed, 'teams could not be fetched; run again to retry them')
 
 
 if __name__ == "__main__":
+    # point BUDA_URL at another server (e.g. a local copy) to scrape that,
+    # and set BUDA_REFRESH_SINCE to a season to check those for changes
+    base_url = os.environ.get('BUDA_URL', BASE_URL)
+    refresh_since = os.environ.get('BUDA_REFRESH_SINCE')
+
     # use links file
     data = parse_file_links("../data/links.txt")
-    scrape_buda(data, "../data/roster_data.tsv")
-
-
-
+    scrape_buda(data, "../data/roster_data.tsv", "../data/roster_cache",
+                base_url, refresh_since=refresh_since)
@@ -0,0 +1,295 @@
+"""
+the player graph as per-season edge weight deltas
+
+data/player_graph/seasons holds each season's weighted edges (the
+teams shared that season) and, per player, the last season they
+played, the index find_recent_players.py queries. player_graph_init.py
+writes it from the whole roster; running this file applies any
+seasons in the roster file that the history doesn't have yet:
+
+* the season's edge weights are added to the graph, in memory, and
+  the snapshot is replaced with the result
+* new players are appended to nodes.csv, and changed edges to
+  edges.csv (a later listing of an edge replaces the earlier one)
+* the recent player list is rewritten from the index
+* the players whose recommendations or ego network sizes may have
+  changed are added to the stale id files, which similar_nodes.py and
+  ego_networks.py read to recompute only those players
+
+the seasons being applied are recorded in the history first, and only
+cleared once all of this is done: an interrupted run leaves them there,
+and later runs refuse to apply anything until the graph is rebuilt
+with player_graph_init.py, rather than add the same weights twice
+"""
+
+import os
+import sys
+import json
+import numpy as np
+sys.path.append('../analyze')
+from graph_functions import (CSRGraph, open_graph_snapshot,
+                             save_graph_snapshot, add_edge_weights,
+                             nodes_within, compact_graph)
+from parse_tools import read_roster
+from player_graph_init import season_edges
+
+SEASON_STORE_VERSION = 1
+
+
+def season_file_name(season_dir, season):
+    """ file holding one season's (3, num_edges) source/target/weight array """
+    return os.path.join(season_dir, 'edges_' + str(season) + '.npy')
+
+
+def roster_node_ids(roster, nodes):
+    """
+    node id of each of the roster's names, given nodes as a dict of id
+    to label: names not yet in nodes get new ids after the last one, in
+    order of first appearance (as player_graph_init would number them).
+    labels are matched without surrounding whitespace, as read_nodes
+    strips them
+    """
+    ids = {label.strip(): uid for uid, label in nodes.items()}
+    next_id = len(nodes) + 1
+    node_ids = []
+    for player in roster.names:
+        if player.strip() not in ids:
+            ids[player.strip()] = next_id
+            next_id += 1
+        node_ids.append(ids[player.strip()])
+    return np.array(node_ids, dtype=np.int64)
+
+
+def save_season(season_dir, season, edges):
+    """ write one season's (sources, targets, weights) """
+    np.save(season_file_name(season_dir, season), np.array(edges))
+
+
+def read_season(season_dir, season):
+    """ read one season's (sources, targets, weights) """
+    sources, targets, weights = np.load(season_file_name(season_dir, season))
+    return sources, targets, weights
+
+
+def season_graph(season_dir, seasons, num_nodes, compact=True):
+    """
+    the graph of just the given seasons, with their edge weights summed,
+    as a CSRGraph over num_nodes nodes; by default in compact dtypes
+    (see compact_graph), so several slices fit in memory at once
+    """
+    edges = [read_season(season_dir, season) for season in seasons]
+    sources, targets, weights = (np.concatenate([edge[i] for edge in edges])
+                                 if edges else np.zeros(0, dtype=np.int64)
+                                 for i in range(3))
+    empty = CSRGraph(np.zeros(num_nodes + 1, dtype=np.int64),
+                     np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    graph, _, _ = add_edge_weights(empty, num_nodes, sources, targets, weights)
+    return compact_graph(graph) if compact else graph
+
+
+def save_season_index(season_dir, seasons, last_seasons):
+    """ write the per-player last seasons and the list of stored seasons """
+    np.save(os.path.join(season_dir, 'last_season.npy'), last_seasons)
+    meta = {'version': SEASON_STORE_VERSION,
+            'seasons': sorted(seasons)}
+    with open(os.path.join(season_dir, 'meta.json'), 'w') as file_out:
+        print(json.dumps(meta), file=file_out)
+
+
+def read_season_index(season_dir):
+    """
+    return the stored seasons and the last season each player played
+    (an array indexed by node id - 1, 0 for none)
+    """
+    with open(os.path.join(season_dir, 'meta.json')) as file_in:
+        meta = json.loads(file_in.read())
+    if meta['version'] != SEASON_STORE_VERSION:
+        raise ValueError('unsupported season store version: ' +
+                         str(meta['version']))
+    last_seasons = np.load(os.path.join(season_dir, 'last_season.npy'))
+    return meta['seasons'], last_seasons
+
+
+def pending_file_name(season_dir):
+    """ file listing the seasons a run started applying but didn't finish """
+    return os.path.join(season_dir, 'pending.json')
+
+
+def read_pending_seasons(season_dir):
+    """ seasons an earlier run started applying and didn't finish, if any """
+    if not os.path.exists(pending_file_name(season_dir)):
+        return []
+    with open(pending_file_name(season_dir)) as file_in:
+        return json.loads(file_in.read())
+
+
+def write_pending_seasons(season_dir, seasons):
+    """ record seasons as being applied, before anything changes """
+    with open(pending_file_name(season_dir), 'w') as file_out:
+        print(json.dumps(sorted(seasons)), file=file_out)
+        file_out.flush()
+        os.fsync(file_out.fileno())
+
+
+def clear_pending_seasons(season_dir):
+    """ mark the seasons being applied as done """
+    if os.path.exists(pending_file_name(season_dir)):
+        os.remove(pending_file_name(season_dir))
+
+
+def last_seasons_played(roster, node_ids, num_nodes, last_seasons=None):
+    """ update (or start) the last season of every player in roster """
+    if last_seasons is None:
+        last_seasons = np.zeros(num_nodes, dtype=np.int64)
+    grown = np.zeros(num_nodes, dtype=np.int64)
+    grown[:len(last_seasons)] = last_seasons
+    np.maximum.at(grown, node_ids[roster.name_ids] - 1, roster.seasons)
+    return grown
+
+
+def build_season_store(roster, nodes, season_dir):
+    """
+    write the per-season history of the whole roster, replacing any
+    earlier one, for the graph player_graph_init builds from it
+    """
+    os.makedirs(season_dir, exist_ok=True)
+    for file_name in os.listdir(season_dir):
+        os.remove(os.path.join(season_dir, file_name))
+
+    node_ids = roster_node_ids(roster, nodes)
+    seasons = season_edges(roster, node_ids)
+    for season, edges in seasons.items():
+        save_season(season_dir, season, edges)
+    save_season_index(season_dir, seasons,
+                      last_seasons_played(roster, node_ids, len(nodes)))
+
+
+def mark_stale(stale_file_name, ids):
+    """
+    add ids to a stale id file, creating it even if there are none, so
+    pipeline.py can tell the analyses' results were updated, not replaced
+    """
+    with open(stale_file_name, 'a') as file_out:
+        for uid in ids:
+            print(uid, file=file_out)
+
+
+def apply_seasons(roster, season_dir, snapshot_dir, node_file_name,
+                  edge_file_name, max_k=6):
+    """
+    add every season of roster missing from the history to the graph
+
+    returns the seasons applied, the updated last seasons, and boolean
+    masks of the players whose recommendations and whose ego network
+    sizes are stale.  the seasons stay recorded as pending until
+    clear_pending_seasons is called, once the stale players are marked:
+
+    * a player's scores only change if their own row or a candidate's
+      row changed, and a candidate can only score above zero within two
+      hops, so recommendations are stale within two hops of a changed row
+    * weight changes don't move ego network sizes; new edges do, for
+      players within max_k - 1 hops of them.  new players change the
+      size of BUDA, the denominator of every coverage, so then all are
+    """
+    seasons, last_seasons = read_season_index(season_dir)
+    pending = read_pending_seasons(season_dir)
+    if pending:
+        raise ValueError('a run applying seasons ' + str(pending) +
+                         ' did not finish, so the graph may hold them in '
+                         'part: rebuild it with player_graph_init.py')
+    new_seasons = sorted(set(roster.seasons.tolist()) - set(seasons))
+    if not new_seasons:
+        return [], last_seasons, None, None
+    write_pending_seasons(season_dir, new_seasons)
+    # changed in memory, and published whole by save_graph_snapshot, so
+    # processes mapping the snapshot never see a half-applied season
+    graph, nodes = open_graph_snapshot(snapshot_dir, in_memory=True)
+    num_old_nodes = graph.num_nodes
+
+    roster = roster.subset(np.isin(roster.seasons, new_seasons))
+    node_ids = roster_node_ids(roster, nodes)
+    num_nodes = max(num_old_nodes, int(node_ids.max()))
+    for player, uid in zip(roster.names, node_ids.tolist()):
+        nodes.setdefault(uid, player)
+
+    changed = []
+    gained = []
+    pairs = []
+    for season, edges in season_edges(roster, node_ids).items():
+        graph, season_changed, season_gained = add_edge_weights(
+            graph, num_nodes, *edges)
+        changed.append(season_changed)
+        gained.append(season_gained)
+        pairs.append(edges[:2])
+        save_season(season_dir, season, edges)
+
+    last_seasons = last_seasons_played(roster, node_ids, num_nodes,
+                                       last_seasons)
+    save_season_index(season_dir, seasons + new_seasons, last_seasons)
+
+    # the csv files first, so the snapshot stays the newer of the two
+    with open(node_file_name, 'a') as file_out:
+        for uid in range(num_old_nodes + 1, num_nodes + 1):
+            print(uid, nodes[uid], sep=',', file=file_out)
+    sources = np.concatenate([p[0] for p in pairs])
+    targets = np.concatenate([p[1] for p in pairs])
+    keys = np.unique(sources * (num_nodes + 1) + targets)
+    with open(edge_file_name, 'a') as file_out:
+        for src, tgt in zip((keys // (num_nodes + 1)).tolist(),
+                            (keys % (num_nodes + 1)).tolist()):
+            indices, weights = graph.row(src - 1)
+            weight = weights[np.searchsorted(indices, tgt - 1)]
+            label = (nodes[src] + " - " + nodes[tgt]).rstrip()
+            print(src, tgt, label, weight, 'undirected', sep=',',
+                  file=file_out)
+
+    save_graph_snapshot(graph, nodes, snapshot_dir)
+
+    stale_similarity = nodes_within(graph, np.concatenate(changed), 2)
+    if num_nodes > num_old_nodes:
+        stale_ego = np.ones(num_nodes, dtype=bool)
+    else:
+        stale_ego = nodes_within(graph, np.concatenate(gained), max_k - 1)
+    return new_seasons, last_seasons, stale_similarity, stale_ego
+
+
+if __name__ == '__main__':
+    roster_file_name = '../data/roster_data.tsv'
+    node_file_name = '../data/player_graph/nodes.csv'
+    edge_file_name = '../data/player_graph/edges.csv'
+    snapshot_dir = '../data/player_graph/snapshot'
+    season_dir = '../data/player_graph/seasons'
+    stale_similarity_file = '../data/player_graph/stale_similarity_ids.txt'
+    stale_ego_file = '../data/player_graph/stale_ego_ids.txt'
+
+    from graph_functions import default_year_thresh, recent_ids_file_name
+    year_thresh = default_year_thresh()
+    candidate_file_name = recent_ids_file_name(year_thresh)
+
+    from find_recent_players import find_recent_ids
+
+    roster = read_roster(roster_file_name)
+    applied, last_seasons, stale_similarity, stale_ego = apply_seasons(
+        roster, season_dir, snapshot_dir, node_file_name, edge_file_name)
+    if not applied:
+        print('no new seasons')
+        quit()
+
+    recent_ids = find_recent_ids(last_seasons, year_thresh)
+    with open(candidate_file_name, 'w') as file_out:
+        for rid in recent_ids:
+            print(rid, file=file_out)
+
+    # only recent players get results, so only they can be stale
+    recent = np.zeros(len(last_seasons), dtype=bool)
+    recent[np.array(recent_ids, dtype=np.int64) - 1] = True
+    stale_similarity_ids = (np.flatnonzero(stale_similarity & recent) + 1)
+    stale_ego_ids = (np.flatnonzero(stale_ego & recent) + 1)
+    mark_stale(stale_similarity_file, stale_similarity_ids.tolist())
+    mark_stale(stale_ego_file, stale_ego_ids.tolist())
+    clear_pending_seasons(season_dir)
+
+    print('applied seasons', applied)
+    print('stale recommendations:', len(stale_similarity_ids),
+          'stale ego network sizes:', len(stale_ego_ids),
+          'of', len(recent_ids), 'recent players')
@@ -0,0 +1,156 @@
+"""
+scrape.py against a local stand-in for buda.org (http.server on a
+free port): caching, conditional refreshes and failed fetches
+
+    python -m unittest test_scrape
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from scrape import scrape_buda
+
+LINK = '/hatleagues/rosters.php?section=showTeamRoster&team={0}&which=10&season=2014'
+
+
+def roster_html(players, links=()):
+    return ('<html><table>' +
+            ''.join('<tr><td class=infobody>{0}</td></tr>'.format(player)
+                    for player in players) +
+            '</table>' +
+            ''.join('<a href="{0}">link</a>'.format(link.replace('&', '&amp;'))
+                    for link in links) +
+            '</html>')
+
+
+class StandInServer(object):
+    """
+    serves pages[path] = (etag, html) with ETag validation; paths in
+    failing answer 404.  requests records (path, status) of each answer
+    """
+    def __init__(self):
+        self.pages = {}
+        self.failing = set()
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in server.failing or self.path not in server.pages:
+                    status, body = 404, b''
+                else:
+                    etag, html = server.pages[self.path]
+                    if self.headers.get('If-None-Match') == etag:
+                        status, body = 304, b''
+                    else:
+                        status, body = 200, html.encode('utf-8')
+                server.requests.append((self.path, status))
+                self.send_response(status)
+                if status != 404:
+                    self.send_header('ETag', server.pages[self.path][0])
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.httpd.server_port)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class ScrapeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.pages[LINK.format(1)] = ('"a1"', roster_html(['Ann', 'Bob']))
+        self.server.pages[LINK.format(2)] = ('"b1"', roster_html(['Cy']))
+        self.data = {'links': [LINK.format(1), LINK.format(2)],
+                     'teams': ['1', '2'], 'leagues': ['10', '10'],
+                     'seasons': ['2014', '2014']}
+        self.dir = tempfile.mkdtemp()
+        self.roster = os.path.join(self.dir, 'roster_data.tsv')
+        self.cache = os.path.join(self.dir, 'cache')
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def scrape(self, refresh_since=None):
+        del self.server.requests[:]
+        scrape_buda(self.data, self.roster, self.cache, self.server.url,
+                    min_interval=0, refresh_since=refresh_since)
+        with open(self.roster) as file_in:
+            return [line.split('\t')[0] for line in file_in]
+
+    def test_cached_pages_are_not_fetched_again(self):
+        self.assertEqual(self.scrape(), ['Ann', 'Bob', 'Cy'])
+        self.assertEqual(self.scrape(), ['Ann', 'Bob', 'Cy'])
+        self.assertEqual(self.server.requests, [])
+
+    def test_refresh_of_unchanged_pages_uses_cache(self):
+        self.scrape()
+        self.assertEqual(self.scrape(refresh_since=2014), ['Ann', 'Bob', 'Cy'])
+        self.assertEqual(sorted(status for path, status in self.server.requests),
+                         [304, 304])
+
+    def test_refresh_picks_up_changed_page(self):
+        self.scrape()
+        self.server.pages[LINK.format(2)] = ('"b2"', roster_html(['Cy', 'Di']))
+        self.assertEqual(self.scrape(refresh_since=2014),
+                         ['Ann', 'Bob', 'Cy', 'Di'])
+        # and the new version is what's cached now
+        self.assertEqual(self.scrape(), ['Ann', 'Bob', 'Cy', 'Di'])
+
+    def test_failed_refresh_keeps_cached_team(self):
+        self.scrape()
+        self.server.failing.add(LINK.format(1))
+        self.assertEqual(self.scrape(refresh_since=2014), ['Ann', 'Bob', 'Cy'])
+        self.assertIn((LINK.format(1), 404), self.server.requests)
+
+    def test_multi_page_roster(self):
+        # page 1 links to page 2 (once as an absolute url) and to sorted
+        # and printable views of itself, page 2 back to both pages
+        link = LINK.format(3)
+        self.server.pages[link] = ('"c1"', roster_html(
+            ['Eve', 'Fay'], [link + '&page=2', link + '&sort=name',
+                             self.server.url + link + '&page=2',
+                             link + '&page=2&print=1']))
+        self.server.pages[link + '&page=2'] = ('"c2"', roster_html(
+            ['Gus'], [link + '&page=1', link + '&page=2']))
+        for view in ('&sort=name', '&page=2&print=1'):
+            self.server.pages[link + view] = ('"v"', roster_html(['Extra']))
+        self.data['links'].append(link)
+        self.data['teams'].append('3')
+        self.data['leagues'].append('10')
+        self.data['seasons'].append('2014')
+
+        everyone = ['Ann', 'Bob', 'Cy', 'Eve', 'Fay', 'Gus']
+        self.assertEqual(self.scrape(), everyone)
+        self.assertEqual(sorted(path for path, status in self.server.requests
+                                if path.startswith(link)),
+                         [link, link + '&page=2'])
+        # both pages come from the cache next time, and refresh together
+        self.assertEqual(self.scrape(), everyone)
+        self.assertEqual(self.server.requests, [])
+        self.server.pages[link + '&page=2'] = ('"c3"',
+                                               roster_html(['Gus', 'Hal']))
+        self.assertEqual(self.scrape(refresh_since=2014), everyone + ['Hal'])
+
+    def test_failed_fetch_without_cache_leaves_team_out(self):
+        self.server.failing.add(LINK.format(1))
+        self.assertEqual(self.scrape(), ['Cy'])
+        # the next run retries it
+        self.server.failing.clear()
+        self.assertEqual(self.scrape(), ['Ann', 'Bob', 'Cy'])
+
+
+if __name__ == "__main__":
+    unittest.main()
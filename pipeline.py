@@ -0,0 +1,459 @@
+"""
+run the pipeline in the README, or part of it, skipping whatever is
+already up to date
+
+    python pipeline.py                      every default stage
+    python pipeline.py ego_networks         that stage and what it needs
+    python pipeline.py year_thresh=2014     with a parameter changed
+    python pipeline.py --force ...          rerun the named (or all) stages
+    python pipeline.py --dry-run ...        just say what would run
+    python pipeline.py -j 1 ...             one stage at a time (default 2)
+
+each stage runs one or more of the scripts, in their own directory as
+the README does, and declares the files it reads and writes.  that
+makes the stages a DAG: a stage runs once the stages writing its inputs
+are done, and stages that don't depend on each other (similar_nodes
+and ego_networks) run at the same time, splitting the cpus between
+their worker pools (BUDA_WORKERS)
+
+a stage's fingerprint hashes the contents of its inputs and of its
+code, and its parameters.  it is skipped if the fingerprint matches the
+one recorded when it last succeeded and its outputs are still what it
+wrote.  otherwise it runs, and first removes its old outputs so it
+starts over, except:
+
+* if its last attempt with the same fingerprint was interrupted, the
+  outputs are kept for it to pick up where it stopped
+* player_graph brings the graph up to date with temporal_graph.py
+  instead of rebuilding it when the roster only gained seasons
+* that marks the players whose results changed in the stale id files
+  (handoffs), and the analyses consuming them update their results in
+  place if nothing but the graph changed
+
+data/roster_data.tsv is the starting point: scrape.py (which needs the
+network) isn't a stage, and network_statistics (which needs matplotlib)
+only runs when named.  stage logs are written to data/pipeline/logs/
+and fingerprints are recorded in data/pipeline/state.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+state_file_name = 'data/pipeline/state.json'
+log_dir = 'data/pipeline/logs'
+roster_file_name = 'data/roster_data.tsv'
+
+# parameters, and the environment variables the scripts read them from
+PARAM_ENV = {'year_thresh': 'BUDA_YEAR_THRESH',
+             'num_to_find': 'BUDA_NUM_TO_FIND'}
+PARAMS = {'year_thresh': int(os.environ.get('BUDA_YEAR_THRESH', 2013)),
+          'num_to_find': int(os.environ.get('BUDA_NUM_TO_FIND', 10))}
+
+
+class Update(object):
+    """
+    a script that brings a stage's outputs up to date in place, run
+    instead of the stage's scripts when applies(recorded key, key) is
+    True for key() as recorded after the stage's last run and now
+    """
+    def __init__(self, script, code, key, applies):
+        self.script = script
+        self.code = list(code)
+        self.key = key
+        self.applies = applies
+
+
+class Stage(object):
+    """
+    scripts of the pipeline, run in turn as python <script> in
+    directory.  inputs and outputs are the files or directories they
+    read and write, and code the source files besides the scripts, all
+    relative to the top of the repository; params names the parameters
+    they use
+
+    handoffs are files written for a later stage, which consumes them
+    (reads and deletes them): they are removed with the outputs, but
+    neither checked nor hashed.  pool stages run a worker pool
+    """
+    def __init__(self, name, directory, scripts, inputs, outputs, code=(),
+                 params=(), handoffs=(), consumes=(), update=None,
+                 pool=False, default=True):
+        self.name = name
+        self.directory = directory
+        self.scripts = list(scripts)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = ([directory + '/' + script for script in scripts] +
+                     list(code))
+        if update:
+            self.code += [directory + '/' + update.script] + update.code
+        self.params = list(params)
+        self.handoffs = list(handoffs)
+        self.consumes = list(consumes)
+        self.update = update
+        self.pool = pool
+        self.default = default
+
+
+def roster_seasons():
+    """ sha256 of each season's rows of the roster, by season """
+    digests = {}
+    with open(roster_file_name, 'rb') as file_in:
+        for line in file_in:
+            season = line.rstrip(b'\r\n').split(b'\t')[-1].decode()
+            digests.setdefault(season, hashlib.sha256()).update(line)
+    return {season: digest.hexdigest() for season, digest in digests.items()}
+
+
+def only_new_seasons(old, new):
+    """ True if new has every season of old, unchanged, and more besides """
+    return (len(new) > len(old) and
+            all(new.get(season) == digest for season, digest in old.items()))
+
+
+def pipeline_stages(params):
+    """ the stages of the pipeline, in README order """
+    graph_dir = 'data/player_graph'
+    nodes = graph_dir + '/nodes.csv'
+    edges = graph_dir + '/edges.csv'
+    seasons = graph_dir + '/seasons'
+    snapshot = graph_dir + '/snapshot'
+    recent = graph_dir + '/node_ids_since_{0}.txt'.format(params['year_thresh'])
+    stale_similarity = graph_dir + '/stale_similarity_ids.txt'
+    stale_ego = graph_dir + '/stale_ego_ids.txt'
+    similarity_results = 'analyze/results/similarity_results.csv'
+    ego_results = 'analyze/results/ego_results.csv'
+    egos = 'app/egos.json'
+
+    graph_code = ['analyze/graph_functions.py', 'analyze/instrument.py']
+    return [
+        # the update appends to nodes.csv and edges.csv, updates seasons/
+        # and the snapshot, and also rewrites the recent player list
+        # (find_recent_players then writes the same)
+        Stage('player_graph', 'create',
+              ['player_graph_init.py', 'graph_snapshot.py'],
+              [roster_file_name], [nodes, edges, seasons, snapshot],
+              ['create/parse_tools.py'] + graph_code,
+              handoffs=[stale_similarity, stale_ego],
+              update=Update('temporal_graph.py',
+                            ['create/player_graph_init.py',
+                             'create/find_recent_players.py'],
+                            roster_seasons, only_new_seasons)),
+        Stage('find_recent_players', 'create', ['find_recent_players.py'],
+              [nodes, seasons, roster_file_name], [recent],
+              ['create/parse_tools.py', 'create/player_graph_init.py',
+               'create/temporal_graph.py'] + graph_code, ['year_thresh']),
+        Stage('similar_nodes', 'analyze', ['similar_nodes.py'],
+              [snapshot, nodes, edges, recent],
+              [similarity_results, 'analyze/results/processed_similarity_ids.txt'],
+              ['analyze/similarity_kernel.py', 'analyze/top_k.py',
+               'analyze/job_runner.py'] + graph_code,
+              ['year_thresh', 'num_to_find'], consumes=[stale_similarity],
+              pool=True),
+        Stage('ego_networks', 'analyze', ['ego_networks.py'],
+              [snapshot, nodes, edges, recent],
+              [ego_results, 'analyze/results/processed_ego_ids.txt'],
+              ['analyze/job_runner.py'] + graph_code, ['year_thresh'],
+              consumes=[stale_ego], pool=True),
+        Stage('jsonify_results', 'app', ['jsonify_results.py'],
+              [similarity_results, ego_results, nodes],
+              ['app/similarities.json', 'app/nodes.json', egos]),
+        Stage('network_statistics', 'analyze', ['network_statistics.py'],
+              [snapshot, nodes, edges, egos],
+              ['analyze/results/network_stats.json'] +
+              ['analyze/results/' + name + '.png' for name in
+               ('wgt_node_deg_vs_edge_weight', 'node_deg_vs_edge_weight',
+                'node_degree_hist', 'edge_weight_hist', 'ego_correlation')],
+              graph_code, default=False),
+    ]
+
+
+class HashCache(object):
+    """
+    sha256 of files and directory trees, reusing a file's recorded hash
+    for as long as its size and modification time are unchanged
+    """
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file_in:
+            for chunk in iter(lambda: file_in.read(1 << 20), b''):
+                digest.update(chunk)
+        self.entries[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def path_hash(self, path):
+        """ hash of a file, or of every file under a directory; None if missing """
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha256()
+        for directory, dirs, files in sorted(os.walk(path)):
+            dirs.sort()
+            for name in sorted(files):
+                file_name = os.path.join(directory, name)
+                digest.update(os.path.relpath(file_name, path).encode())
+                digest.update(self.file_hash(file_name).encode())
+        return digest.hexdigest()
+
+
+def code_fingerprint(stage, params, hashes):
+    """ hash of a stage's parameters and the contents of its code """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([stage.name, stage.directory, stage.scripts,
+                              {name: params[name] for name in stage.params}],
+                             sort_keys=True).encode())
+    for path in stage.code:
+        digest.update(path.encode())
+        digest.update(str(hashes.path_hash(path)).encode())
+    return digest.hexdigest()
+
+
+def fingerprint(stage, params, hashes):
+    """ code_fingerprint, and the contents of the stage's inputs """
+    digest = hashlib.sha256(code_fingerprint(stage, params, hashes).encode())
+    for path in stage.inputs:
+        digest.update(path.encode())
+        digest.update(str(hashes.path_hash(path)).encode())
+    return digest.hexdigest()
+
+
+def read_state():
+    if not os.path.exists(state_file_name):
+        return {'hashes': {}, 'stages': {}}
+    with open(state_file_name) as file_in:
+        return json.loads(file_in.read())
+
+
+def save_state(state):
+    os.makedirs(os.path.dirname(state_file_name), exist_ok=True)
+    with open(state_file_name + '.tmp', 'w') as file_out:
+        print(json.dumps(state, indent=1, sort_keys=True), file=file_out)
+    os.replace(state_file_name + '.tmp', state_file_name)
+
+
+def outputs_intact(stage, record, hashes):
+    """ True if every output is still what the stage last wrote """
+    recorded = record.get('outputs', {})
+    return all(path in recorded and hashes.path_hash(path) == recorded[path]
+               for path in stage.outputs)
+
+
+def remove_outputs(stage):
+    for path in stage.outputs + stage.handoffs:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def run_mode(stage, record, stage_fingerprint, code, hashes, force):
+    """
+    how a stage that isn't up to date runs: 'resume' or 'update' (in
+    place, keeping its outputs) or 'full' (starting over)
+    """
+    if stage.name in force:
+        return 'full'
+    if record.get('started') == stage_fingerprint:
+        # an interrupted update script may have been half applied
+        if stage.update and record.get('mode') == 'update':
+            return 'full'
+        return 'resume'
+    if (record.get('code') != code or not record.get('fingerprint') or
+            not outputs_intact(stage, record, hashes)):
+        return 'full'
+    if stage.update and stage.update.applies(record.get('update_key', {}),
+                                             stage.update.key()):
+        return 'update'
+    if any(os.path.exists(path) for path in stage.consumes):
+        return 'update'
+    return 'full'
+
+
+def run_stage(stage, params, mode, num_workers):
+    """
+    run a stage's scripts (or its update script), logging their output;
+    return the first nonzero exit code, or 0
+    """
+    env = dict(os.environ)
+    env.update({PARAM_ENV[name]: str(value) for name, value in params.items()})
+    if stage.pool:
+        env['BUDA_WORKERS'] = str(num_workers)
+    for path in stage.outputs + stage.handoffs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+
+    scripts = [stage.update.script] if mode == 'update' and stage.update \
+        else stage.scripts
+    with open(os.path.join(log_dir, stage.name + '.log'), 'w') as log:
+        for script in scripts:
+            returncode = subprocess.call([sys.executable, script],
+                                         cwd=stage.directory, env=env,
+                                         stdout=log, stderr=subprocess.STDOUT)
+            if returncode:
+                return returncode
+    return 0
+
+
+def required_stages(stages, targets):
+    """
+    the names of the target stages and everything they depend on, and
+    each stage's dependencies (the stages writing its inputs)
+    """
+    producers = {path: stage.name for stage in stages
+                 for path in stage.outputs + stage.handoffs}
+    depends = {stage.name: sorted(set(producers[path]
+                                      for path in stage.inputs + stage.consumes
+                                      if path in producers))
+               for stage in stages}
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending += depends[name]
+    return needed, depends
+
+
+def run_pipeline(stages, targets, params, force=(), dry_run=False, jobs=2):
+    """
+    bring the target stages up to date, running stages whose
+    dependencies are done concurrently (up to jobs at a time).  the
+    stages named in force start over even if they are up to date.
+    returns a dict of stage name: (status, seconds)
+    """
+    needed, depends = required_stages(stages, targets)
+    todo = [stage for stage in stages if stage.name in needed]
+    state = read_state()
+    hashes = HashCache(state['hashes'])
+    status = {}
+    running = {}
+
+    # pool stages that may run side by side share the cpus
+    parallel_pools = max(1, min(jobs, sum(stage.pool for stage in todo)))
+    num_workers = max(1, ((os.cpu_count() or 1) - 1) // parallel_pools)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            # start (or skip) everything whose dependencies are done
+            for stage in todo:
+                if stage.name in status or any(
+                        status.get(dep, ('',))[0] not in ('ran', 'up to date',
+                                                          'would run')
+                        for dep in depends[stage.name]):
+                    continue
+                record = state['stages'].setdefault(stage.name, {})
+                code = code_fingerprint(stage, params, hashes)
+                stage_fingerprint = fingerprint(stage, params, hashes)
+                upstream_runs = any(status[dep][0] == 'would run'
+                                    for dep in depends[stage.name])
+                if (stage.name not in force and not upstream_runs and
+                        record.get('fingerprint') == stage_fingerprint and
+                        outputs_intact(stage, record, hashes)):
+                    status[stage.name] = ('up to date', 0.0)
+                    print(stage.name + ': up to date')
+                    continue
+                mode = run_mode(stage, record, stage_fingerprint, code, hashes,
+                                force)
+                if dry_run:
+                    # how depends on what the stages before it write
+                    status[stage.name] = ('would run', 0.0)
+                    print(stage.name + ': would run' +
+                          ('' if upstream_runs else ' ({0})'.format(mode)))
+                    continue
+
+                if mode == 'full':
+                    remove_outputs(stage)
+                record.update({'started': stage_fingerprint, 'mode': mode})
+                save_state(state)
+                print('{0}: running ({1})'.format(stage.name, mode))
+                future = executor.submit(run_stage, stage, params, mode,
+                                         num_workers)
+                running[future] = (stage, stage_fingerprint, code, time.time())
+                status[stage.name] = ('running', 0.0)
+
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, stage_fingerprint, code, start = running.pop(future)
+                seconds = time.time() - start
+                if future.result() != 0:
+                    status[stage.name] = ('failed', seconds)
+                    print('{0}: failed, see {1}/{0}.log'.format(stage.name,
+                                                                log_dir))
+                    continue
+                record = state['stages'][stage.name]
+                record.update({'fingerprint': stage_fingerprint, 'code': code,
+                               'outputs': {path: hashes.path_hash(path)
+                                           for path in stage.outputs}})
+                if stage.update:
+                    record['update_key'] = stage.update.key()
+                state['hashes'] = hashes.entries
+                save_state(state)
+                status[stage.name] = ('ran', seconds)
+                print('{0}: done in {1:.1f}s'.format(stage.name, seconds))
+
+    for stage in todo:
+        if stage.name not in status:
+            status[stage.name] = ('not run', 0.0)
+            print(stage.name + ': not run, a stage it needs failed')
+    state['hashes'] = hashes.entries
+    if not dry_run:
+        save_state(state)
+    return status
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    args = sys.argv[1:]
+    force = '--force' in args
+    dry_run = '--dry-run' in args
+    jobs = 2
+    if '-j' in args:
+        jobs = int(args[args.index('-j') + 1])
+        del args[args.index('-j'):args.index('-j') + 2]
+
+    params = dict(PARAMS)
+    targets = []
+    for arg in args:
+        if arg.startswith('--'):
+            continue
+        if '=' in arg:
+            name, value = arg.split('=', 1)
+            if name not in params:
+                sys.exit('unknown parameter ' + name)
+            params[name] = int(value)
+        else:
+            targets.append(arg)
+
+    stages = pipeline_stages(params)
+    names = [stage.name for stage in stages]
+    for target in targets:
+        if target not in names:
+            sys.exit('unknown stage {0}; stages are {1}'.format(
+                     target, ', '.join(names)))
+
+    targets = targets or [stage.name for stage in stages if stage.default]
+    try:
+        status = run_pipeline(stages, targets, params,
+                              targets if force else (), dry_run, jobs)
+    except KeyboardInterrupt:
+        sys.exit('interrupted: run again to pick up where it stopped')
+    if any(result == 'failed' for result, seconds in status.values()):
+        sys.exit(1)